@@ -0,0 +1,337 @@
+"""
+asyncio counterpart of PlaidAPI, built on the optional aiohttp package.
+
+Every request is a coroutine, so a single thread can keep requests for
+hundreds of items in flight at once instead of needing a thread for each
+(see --async in plaid-sync.py). Retries, rate limiting, the response cache
+and the mapping of Plaid errors work the same way as in PlaidAPI.
+"""
+
+import asyncio
+import collections
+import datetime
+import itertools
+import time
+from typing import List, Optional
+
+import plaid
+from plaid.internal.utils import urljoin
+
+import metrics
+from plaidapi import (NOT_RETRYABLE_ON_CONNECTION_ERROR, TRANSACTIONS_PAGE_SIZE, RetryPolicy, TokenBucket, fetched_date,
+                      is_retryable, parse_plaid_response, wrap_plaid_error)
+from plaidmodels import AccountBalance, AccountInfo, Transaction, TransactionsDelta
+from responsecache import ResponseCache
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncPlaidClient:
+    """
+    Sends requests to the Plaid API like PlaidClient does, over an aiohttp
+    session holding up to pool_size connections.
+
+    The session is created on first use, as it has to belong to the event
+    loop the requests run on.
+    """
+    def __init__(self, client_id: str, secret: str, environment: str, base_url: Optional[str]=None,
+                 retry_policy: Optional[RetryPolicy]=None, rate_limiter: Optional[TokenBucket]=None,
+                 pool_size: int=100, connect_timeout: Optional[float]=None, read_timeout: Optional[float]=None):
+        if aiohttp is None:
+            raise ValueError("AsyncPlaidAPI requires the aiohttp package")
+
+        self.client_id       = client_id
+        self.secret          = secret
+        self.base_url        = base_url or ('https://' + environment + '.plaid.com')
+        self.retry_policy    = retry_policy or RetryPolicy(max_retries=0)
+        self.rate_limiter    = rate_limiter
+        self.pool_size       = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout    = read_timeout
+        self.session         = None
+
+    def get_session(self) -> 'aiohttp.ClientSession':
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                headers={'User-Agent': 'Plaid Python v{}'.format(plaid.version.__version__)},
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post(self, path: str, data: dict, is_json: bool=True):
+        """
+        Makes a post request with client_id and secret key.
+        """
+        post_data = {
+            'client_id': self.client_id,
+            'secret': self.secret,
+        }
+        post_data.update(data)
+
+        attempt = 0
+        while True:
+            try:
+                return await self._post_once(path, post_data, is_json)
+            except plaid.errors.PlaidError as ex:
+                if ex.type == 'RATE_LIMIT_EXCEEDED':
+                    metrics.count("rate_limited")
+                    if self.rate_limiter:
+                        self.rate_limiter.rate_limited()
+                if not is_retryable(ex) or attempt >= self.retry_policy.max_retries:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if path in NOT_RETRYABLE_ON_CONNECTION_ERROR or attempt >= self.retry_policy.max_retries:
+                    raise
+
+            metrics.count("retries")
+            await asyncio.sleep(self.retry_policy.delay(attempt))
+            attempt += 1
+
+    async def _post_once(self, path: str, data: dict, is_json: bool):
+        if self.rate_limiter:
+            with metrics.timer("rate_limit_wait"):
+                while True:
+                    wait = self.rate_limiter.try_acquire()
+                    if not wait:
+                        break
+                    await asyncio.sleep(wait)
+
+        async with self.get_session().post(urljoin(self.base_url, path), json=data) as response:
+            content = await response.read()
+            content_type = response.headers.get('Content-Type')
+
+        metrics.count("api_calls")
+        metrics.count("api_bytes", len(content))
+
+        result = parse_plaid_response(content, content_type, is_json)
+        if self.rate_limiter:
+            self.rate_limiter.succeeded()
+        return result
+
+
+class AsyncPlaidAPI():
+    def __init__(self, client_id: str, secret: str, environment: str, suppress_warnings=True, page_fanout: int=4, base_url: Optional[str]=None,
+                 max_retries: int=5, requests_per_second: Optional[float]=50, pool_size: Optional[int]=None,
+                 connect_timeout: float=10, read_timeout: float=600, response_cache: Optional[ResponseCache]=None):
+        """
+        Takes the same options as PlaidAPI. suppress_warnings only applies
+        to the Plaid SDK's client and is ignored.
+        """
+        self.client = AsyncPlaidClient(
+            client_id,
+            secret,
+            environment,
+            base_url=base_url,
+            retry_policy=RetryPolicy(max_retries=max_retries),
+            rate_limiter=TokenBucket(requests_per_second) if requests_per_second else None,
+            pool_size=pool_size or page_fanout,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        self.page_fanout = page_fanout
+        self.response_cache = response_cache
+
+    async def close(self):
+        await self.client.close()
+
+    async def cached_response(self, endpoint: str, access_token: str, fetch):
+        """
+        See PlaidAPI.cached_response. The cache is a SQLite database, so it
+        is read and written on the loop's default executor rather than
+        blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.response_cache:
+            cached = await loop.run_in_executor(None, self.response_cache.get, endpoint, access_token)
+            if cached is not None:
+                metrics.count("cache_hits")
+                return cached
+            metrics.count("cache_misses")
+
+        response = await fetch()
+        if self.response_cache:
+            await loop.run_in_executor(None, self.response_cache.put, endpoint, access_token, response)
+        return response, time.time()
+
+    def invalidate_cache(self, access_token: Optional[str]=None):
+        """
+        Drops cached responses for access_token, or for every item. Blocks,
+        so call it on an executor from the event loop.
+        """
+        if self.response_cache:
+            self.response_cache.invalidate(access_token)
+
+    @wrap_plaid_error
+    async def get_link_token(self, access_token=None) -> str:
+        """
+        See PlaidAPI.get_link_token.
+        """
+        data = {
+            'user': {
+                'client_user_id': 'abc123',
+            },
+            'client_name': 'plaid-sync',
+            'country_codes': ['US'],
+            'language': 'en',
+        }
+
+        # if updating an existing account, the products field is not allowed
+        if access_token:
+            data['access_token'] = access_token
+        else:
+            data['products'] = ['transactions']
+
+        return (await self.client.post('/link/token/create', data))['link_token']
+
+    @wrap_plaid_error
+    async def exchange_public_token(self, public_token: str) -> dict:
+        """
+        Exchange a temporary public token for a permanent private
+        access token.
+        """
+        return await self.client.post('/item/public_token/exchange', {
+            'public_token': public_token,
+        })
+
+    @wrap_plaid_error
+    async def sandbox_reset_login(self, access_token: str) -> dict:
+        """
+        See PlaidAPI.sandbox_reset_login.
+        """
+        return await self.client.post('/sandbox/item/reset_login', {
+            'access_token': access_token,
+        })
+
+    @wrap_plaid_error
+    async def get_item_info(self, access_token: str) -> AccountInfo:
+        """
+        Returns account information associated with this particular access token.
+        """
+        resp = await self.client.post('/item/get', {
+            'access_token': access_token,
+        })
+        return AccountInfo(resp)
+
+    @wrap_plaid_error
+    async def get_account_balance(self, access_token: str) -> List[AccountBalance]:
+        """
+        Returns the balances of all accounts associated with this particular access_token.
+        """
+        resp, fetched = await self.cached_response('balances', access_token, lambda: self.client.post('/accounts/balance/get', {
+            'access_token': access_token,
+            'options': {},
+        }))
+        return [ AccountBalance(account, fetched_date(fetched)) for account in resp['accounts'] ]
+
+    @wrap_plaid_error
+    async def iter_transaction_pages(self, access_token: str, start_date: datetime.date, end_date: datetime.date, account_ids: Optional[List[str]]=None, status_callback=None, page_fanout: Optional[int]=None):
+        """
+        Yields the transactions between start_date and end_date one page at a
+        time, in offset order, with up to page_fanout pages requested ahead.
+        See PlaidAPI.iter_transaction_pages.
+        """
+        page_fanout = page_fanout or self.page_fanout
+
+        def fetch_page(offset):
+            options = {
+                'count': TRANSACTIONS_PAGE_SIZE,
+                'offset': offset,
+            }
+            if account_ids is not None:
+                options['account_ids'] = account_ids
+            return self.client.post('/transactions/get', {
+                'access_token': access_token,
+                'start_date': start_date.strftime("%Y-%m-%d"),
+                'end_date': end_date.strftime("%Y-%m-%d"),
+                'options': options,
+            })
+
+        response = await fetch_page(0)
+        metrics.count("pages")
+        total_transactions = response['total_transactions']
+        fetched = len(response['transactions'])
+        if status_callback: status_callback(fetched, total_transactions)
+        yield [Transaction(t) for t in response['transactions']]
+
+        if not fetched:
+            return
+
+        offsets = iter(range(fetched, total_transactions, TRANSACTIONS_PAGE_SIZE))
+        pending = collections.deque(
+            asyncio.ensure_future(fetch_page(offset))
+            for offset in itertools.islice(offsets, page_fanout)
+        )
+        try:
+            while pending:
+                response = await pending.popleft()
+                for offset in itertools.islice(offsets, 1):
+                    pending.append(asyncio.ensure_future(fetch_page(offset)))
+
+                metrics.count("pages")
+                fetched += len(response['transactions'])
+                if status_callback: status_callback(fetched, total_transactions)
+                yield [Transaction(t) for t in response['transactions']]
+        finally:
+            # pages still being fetched after an error are not needed; wait
+            # for them to wind down, dropping their results and errors
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def get_transactions(self, access_token: str, start_date: datetime.date, end_date: datetime.date, account_ids: Optional[List[str]]=None, status_callback=None, page_fanout: Optional[int]=None):
+        """
+        Returns all transactions between start_date and end_date, deduplicated
+        by transaction_id. See iter_transaction_pages.
+        """
+        ret = {}
+        async for page in self.iter_transaction_pages(access_token, start_date, end_date, account_ids, status_callback, page_fanout):
+            for t in page:
+                ret.setdefault(t.transaction_id, t)
+        return list(ret.values())
+
+    @wrap_plaid_error
+    async def get_transactions_delta(self, access_token: str, cursor: Optional[str]=None) -> TransactionsDelta:
+        """
+        Returns everything added, modified and removed since cursor, using
+        /transactions/sync. See PlaidAPI.get_transactions_delta.
+        """
+        restarts = 0
+        while True:
+            added, modified, removed = [], [], []
+            next_cursor = cursor
+            try:
+                while True:
+                    data = {
+                        'access_token': access_token,
+                        'count': TRANSACTIONS_PAGE_SIZE,
+                    }
+                    if next_cursor:
+                        data['cursor'] = next_cursor
+
+                    response = await self.client.post('/transactions/sync', data)
+                    metrics.count("pages")
+
+                    added    += [ Transaction(t) for t in response['added'] ]
+                    modified += [ Transaction(t) for t in response['modified'] ]
+                    removed  += [ t['transaction_id'] for t in response['removed'] ]
+                    next_cursor = response['next_cursor']
+
+                    if not response['has_more']:
+                        return TransactionsDelta(added, modified, removed, next_cursor)
+            except plaid.errors.PlaidError as ex:
+                retry_policy = self.client.retry_policy
+                if ex.code != 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION' or restarts >= retry_policy.max_retries:
+                    raise
+
+            metrics.count("retries")
+            await asyncio.sleep(retry_policy.delay(restarts))
+            restarts += 1
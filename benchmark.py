@@ -0,0 +1,331 @@
+#!python
+"""
+Offline performance benchmark for plaid-sync.
+
+Starts the fake Plaid server (fakeplaid.py) with synthetic data in a child
+process, then times:
+
+    sync    PlaidSynchronizer.sync for every item, in this process, reporting
+            time spent fetching from the API and writing to the database
+    main    the plaid-sync.py command line, in a child process
+    unchanged
+            PlaidSynchronizer.sync for every item, without --force, after
+            an initial load: no item has been refreshed since, so only item
+            info and balances are fetched and saved
+    startup the --report commands of plaid-sync.py against the synchronized
+            database, and importing the modules a sync needs, each timed
+            with python -X importtime
+
+The sync and main scenarios run twice against a fresh database: an initial
+load, where every transaction is new, and a resync, where nothing has
+changed. Both passes are forced, so the resync still fetches and compares
+every transaction rather than skipping the unchanged items.
+
+    python benchmark.py --items 10 --accounts 2 --transactions 2000 --days 730 --latency 0.05
+
+Use --json to save the results, so runs before and after a change can be
+compared.
+"""
+
+import argparse
+import datetime
+import importlib.util
+import inspect
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import transactionsdb
+import plaidapi
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_plaid_sync():
+    # plaid-sync.py is a script, not an importable module name
+    spec = importlib.util.spec_from_file_location("plaid_sync", os.path.join(REPO_DIR, "plaid-sync.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Timed:
+    """
+    Wraps an object and adds up the wall time spent in its method calls,
+    including time spent iterating any generators they return.
+    """
+    def __init__(self, target):
+        self._target  = target
+        self._lock    = threading.Lock()
+        self.elapsed  = 0.0
+
+    def _add(self, elapsed):
+        with self._lock:
+            self.elapsed += elapsed
+
+    def _timed_generator(self, generator):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                self._add(time.perf_counter() - start)
+            yield item
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                self._add(time.perf_counter() - start)
+            if inspect.isgenerator(result):
+                return self._timed_generator(result)
+            return result
+        return timed
+
+
+def peak_rss_mib(rusage) -> float:
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    return rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def start_fake_server(args) -> (subprocess.Popen, str):
+    proc = subprocess.Popen(
+        [
+            sys.executable, os.path.join(REPO_DIR, "fakeplaid.py"),
+            "--port", "0",
+            "--items", str(args.items),
+            "--accounts", str(args.accounts),
+            "--transactions", str(args.transactions),
+            "--days", str(args.days),
+            "--latency", str(args.latency),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    # first line is "Fake Plaid API listening on http://host:port"
+    base_url = proc.stdout.readline().strip().split()[-1]
+    return proc, base_url
+
+
+def write_config(path: str, base_url: str, dbfile: str, args):
+    with open(path, "w") as f:
+        f.write("[PLAID]\n")
+        f.write("client_id = fake\nsecret = fake\nenvironment = sandbox\n")
+        f.write("base_url = %s\n" % base_url)
+        f.write("page_fanout = %d\n" % args.page_fanout)
+        f.write("\n[plaid-sync]\ndbfile = %s\n" % dbfile)
+        for i in range(args.items):
+            f.write("\n[Fake Bank %d]\naccess_token = access-fake-%d\n" % (i, i))
+
+
+def run_sync(plaid_sync, base_url: str, dbfile: str, args, start_date, end_date, force: bool=True) -> Dict:
+    raw_db = transactionsdb.TransactionsDB(dbfile)
+    db     = Timed(raw_db)
+    plaid  = Timed(plaidapi.PlaidAPI("fake", "fake", "sandbox", page_fanout=args.page_fanout, base_url=base_url))
+
+    fetched = written = 0
+    start = time.perf_counter()
+    for i in range(args.items):
+        sync = plaid_sync.PlaidSynchronizer(db, plaid, "Fake Bank %d" % i, "access-fake-%d" % i)
+        sync.sync(start_date, end_date, fetch_balances=True, batch_size=args.batch_size, force=force)
+        if sync.plaid_error:
+            raise sync.plaid_error
+        fetched += sync.counts.total_fetched
+        written += sync.counts.new + sync.counts.modified + sync.counts.archived
+    wall = time.perf_counter() - start
+
+    raw_db.conn.close()
+
+    return {
+        "wall": wall,
+        "fetched": fetched,
+        "fetch_rate": fetched / plaid.elapsed if plaid.elapsed else None,
+        "written": written,
+        "write_rate": written / db.elapsed if db.elapsed else None,
+        "peak_rss_mib": peak_rss_mib(resource.getrusage(resource.RUSAGE_SELF)),
+    }
+
+
+def run_main(config_file: str, args, start_date, end_date) -> Dict:
+    command = [
+        sys.executable, os.path.join(REPO_DIR, "plaid-sync.py"),
+        "-c", config_file,
+        "-b",
+        "-f",
+        "-s", start_date.strftime("%Y-%m-%d"),
+        "-e", end_date.strftime("%Y-%m-%d"),
+        "--jobs", str(args.jobs),
+    ]
+    if args.batch_size:
+        command += ["--batch-size", str(args.batch_size)]
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError("plaid-sync.py exited with status %d" % proc.returncode)
+
+    return {
+        "wall": wall,
+        "peak_rss_mib": peak_rss_mib(rusage),
+    }
+
+
+def import_seconds(importtime_output: str) -> float:
+    """
+    Total of the cumulative times of the top level imports in the output of
+    python -X importtime.
+    """
+    total = 0
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # nested imports are indented, and already counted by their parent
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1e6
+
+
+def run_startup(command: List[str], repeat: int=5) -> Dict:
+    """
+    Runs command under python -X importtime, and returns the fastest of
+    repeat runs.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime"] + command, cwd=REPO_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        wall = time.perf_counter() - start
+        if proc.returncode != 0:
+            raise RuntimeError("%s exited with status %d" % (" ".join(command), proc.returncode))
+        if best is None or wall < best["wall"]:
+            best = {
+                "wall": wall,
+                "import_seconds": import_seconds(proc.stderr),
+            }
+    return best
+
+
+def format_results(results: List[Dict]) -> str:
+    def fmt(value, pattern):
+        return pattern % value if value is not None else "-"
+
+    lines = ["%-32s %9s %11s %9s %11s %9s %11s %14s" % (
+        "scenario", "wall (s)", "imports (s)", "fetched", "fetched/s", "written", "written/s", "peak RSS (MiB)")]
+    for r in results:
+        lines.append("%-32s %9s %11s %9s %11s %9s %11s %14s" % (
+            r["scenario"],
+            fmt(r.get("wall"), "%.3f" if "import_seconds" in r else "%.2f"),
+            fmt(r.get("import_seconds"), "%.3f"),
+            fmt(r.get("fetched"), "%d"),
+            fmt(r.get("fetch_rate"), "%.0f"),
+            fmt(r.get("written"), "%d"),
+            fmt(r.get("write_rate"), "%.0f"),
+            fmt(r.get("peak_rss_mib"), "%.1f"),
+        ))
+    return "\n".join(lines)
+
+
+SCENARIOS = ["sync", "main", "unchanged", "startup"]
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Benchmark plaid-sync against a local fake Plaid server")
+    parser.add_argument("--items",        dest="items",        type=int,   default=5,    help="Number of items (bank logins). Defaults to 5.")
+    parser.add_argument("--accounts",     dest="accounts",     type=int,   default=2,    help="Accounts per item. Defaults to 2.")
+    parser.add_argument("--transactions", dest="transactions", type=int,   default=2000, help="Transactions per account. Defaults to 2000.")
+    parser.add_argument("--days",         dest="days",         type=int,   default=730,  help="Days of history the transactions are spread over. Defaults to 730.")
+    parser.add_argument("--latency",      dest="latency",      type=float, default=0.05, help="Seconds of latency added to every API response. Defaults to 0.05.")
+    parser.add_argument("--page-fanout",  dest="page_fanout",  type=int,   default=4,    help="Transaction pages fetched concurrently. Defaults to 4.")
+    parser.add_argument("--batch-size",   dest="batch_size",   type=int,                 help="If set, use the streaming sync with this batch size.")
+    parser.add_argument("--jobs",         dest="jobs",         type=int,   default=4,    help="--jobs passed to plaid-sync.py in the main scenario. Defaults to 4.")
+    parser.add_argument("--scenario",     dest="scenarios",    action="append", choices=SCENARIOS,
+                                                                                         help="Scenario to run, may be repeated. Defaults to all.")
+    parser.add_argument("--json",         dest="json_file",                              help="Also write the results as JSON to this file.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_options()
+    scenarios = args.scenarios or SCENARIOS
+
+    end_date   = datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=args.days)
+
+    print("Synthetic data: %d items x %d accounts x %d transactions over %d days, %dms latency" % (
+        args.items, args.accounts, args.transactions, args.days, args.latency * 1000))
+    print("")
+
+    server, base_url = start_fake_server(args)
+    tmpdir = tempfile.mkdtemp(prefix="plaid-sync-benchmark-")
+    results = []
+    try:
+        if "sync" in scenarios:
+            plaid_sync = load_plaid_sync()
+            dbfile = os.path.join(tmpdir, "sync.db")
+            for run in ("initial", "resync"):
+                result = run_sync(plaid_sync, base_url, dbfile, args, start_date, end_date)
+                result["scenario"] = "sync (%s)" % run
+                results.append(result)
+
+        if "unchanged" in scenarios:
+            plaid_sync = load_plaid_sync()
+            dbfile = os.path.join(tmpdir, "unchanged.db")
+            run_sync(plaid_sync, base_url, dbfile, args, start_date, end_date)
+            result = run_sync(plaid_sync, base_url, dbfile, args, start_date, end_date, force=False)
+            result["scenario"] = "unchanged (skipped)"
+            results.append(result)
+
+        dbfile = os.path.join(tmpdir, "main.db")
+        config_file = os.path.join(tmpdir, "benchmark.cfg")
+        write_config(config_file, base_url, dbfile, args)
+
+        if "main" in scenarios:
+            for run in ("initial", "resync"):
+                result = run_main(config_file, args, start_date, end_date)
+                result["scenario"] = "main (%s, --jobs %d)" % (run, args.jobs)
+                results.append(result)
+
+        if "startup" in scenarios:
+            if not os.path.exists(dbfile):
+                run_main(config_file, args, start_date, end_date)
+            for report in ("items", "balances", "transactions"):
+                result = run_startup(["plaid-sync.py", "-c", config_file, "--report", report])
+                result["scenario"] = "startup (--report %s)" % report
+                results.append(result)
+            result = run_startup(["-c", "import config, plaidapi, responsecache, transactionsdb"])
+            result["scenario"] = "startup (sync imports)"
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmpdir)
+
+    print(format_results(results))
+
+    if args.json_file:
+        with open(args.json_file, "w") as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Optional compression of the plaid_json columns.
+
+Compressed values are stored as blobs with a 3 byte header - the codec and
+the id of the shared dictionary it was compressed with (0 for none) -
+followed by the compressed JSON. Uncompressed values stay plain text, so
+databases can hold a mix of both and are converted row by row.
+
+Plaid payloads are small and very alike (the same keys, categories and
+merchant names over and over), so most of the gain comes from compressing
+against a dictionary built from stored payloads: zlib's preset dictionary,
+or a trained zstd dictionary if the optional zstandard package is
+installed.
+"""
+
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = {
+    'zlib': 1,
+    'zstd': 2,
+}
+
+HEADER = struct.Struct(">BH")
+
+# zlib only looks back 32 KiB, so a larger preset dictionary is wasted
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ZSTD_DICTIONARY_SIZE = 64 * 1024
+
+
+def check_codec(codec: Optional[str]):
+    if codec is None:
+        return
+    if codec not in CODECS:
+        raise ValueError("Invalid compression [%s], must be one of %s" % (codec, ", ".join(CODECS)))
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("Compression [zstd] requires the zstandard package")
+
+
+def train_dictionary(codec: str, samples: List[bytes]) -> bytes:
+    """
+    Builds a shared dictionary for codec from sample payloads.
+    """
+    if codec == 'zstd':
+        return zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples).as_bytes()
+
+    # a zlib preset dictionary is just text the compressor can refer back
+    # to; the end of it is cheapest to reference, so whole samples are
+    # packed in up to the size limit
+    dictionary = b""
+    for sample in samples:
+        if len(dictionary) + len(sample) > ZLIB_DICTIONARY_SIZE:
+            break
+        dictionary += sample
+    return dictionary
+
+
+class JSONCompressor:
+    def __init__(self, codec: Optional[str], dictionaries: Dict[int, Tuple[str, bytes]]):
+        """
+        codec is the codec new values are compressed with (None to store
+        them as text), using the newest of its dictionaries. dictionaries
+        maps dictionary ids to (codec, dictionary), and must contain every
+        dictionary used by stored values.
+        """
+        check_codec(codec)
+        self.codec        = codec
+        self.dictionaries = dictionaries
+        self.dict_id      = max((i for i, (c, _) in dictionaries.items() if c == codec), default=0)
+        self.zstd_compressor   = None
+        self.zstd_decompressors = {}
+
+        if codec == 'zstd':
+            if self.dict_id:
+                dict_data = zstandard.ZstdCompressionDict(dictionaries[self.dict_id][1])
+                self.zstd_compressor = zstandard.ZstdCompressor(dict_data=dict_data)
+            else:
+                self.zstd_compressor = zstandard.ZstdCompressor()
+
+    def compress(self, text: str) -> Union[str, bytes]:
+        if not self.codec:
+            return text
+
+        data = text.encode("utf-8")
+        header = HEADER.pack(CODECS[self.codec], self.dict_id)
+        if self.codec == 'zstd':
+            # zstd compressors are not thread safe, but TransactionsDB is
+            # only ever used from one thread
+            return header + self.zstd_compressor.compress(data)
+
+        if self.dict_id:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.dictionaries[self.dict_id][1])
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        return header + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, value: Union[None, str, bytes]) -> Optional[str]:
+        if value is None or isinstance(value, str):
+            return value
+
+        codec, dict_id = HEADER.unpack_from(value)
+        data = value[HEADER.size:]
+        if codec == CODECS['zstd']:
+            decompressor = self.zstd_decompressors.get(dict_id)
+            if decompressor is None:
+                if zstandard is None:
+                    raise ValueError("Value is zstd compressed, which requires the zstandard package")
+                if dict_id:
+                    decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(self.dictionaries[dict_id][1]))
+                else:
+                    decompressor = zstandard.ZstdDecompressor()
+                self.zstd_decompressors[dict_id] = decompressor
+            return decompressor.decompress(data).decode("utf-8")
+
+        if dict_id:
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionaries[dict_id][1])
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
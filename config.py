@@ -9,20 +9,76 @@ secret = xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
 public_key = xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
 environment = development
 suppress_warnings=true
+; optional: number of transaction pages fetched concurrently per account
+page_fanout = 4
+; optional: send API requests somewhere other than https://<environment>.plaid.com
+; e.g. a local fake Plaid server (fakeplaid.py) for offline testing
+base_url = http://127.0.0.1:4584
+; optional: retries of rate limited / transiently failing requests, and the
+; maximum request rate shared by all accounts (lowered automatically when
+; Plaid reports rate limiting, 0 for no limit)
+max_retries = 5
+requests_per_second = 50
+; optional: seconds to wait for a connection to Plaid, and for a response
+connect_timeout = 10
+read_timeout = 600
 
 [plaid-sync]
 dbfile = /data/transactions.db
+; optional SQLite tuning, see TransactionsDB
+sqlite_synchronous = NORMAL
+sqlite_cache_size = -16000
+; optional: store plaid_json compressed (zlib, or zstd if the zstandard package
+; is installed; none by default); run --recompress to convert existing data and train the
+; shared compression dictionary
+compression = zlib
+; optional: days after which a posted transaction is assumed not to change any
+; more, for working out each account's sync window when no start date is given
+settle_days = 14
+; optional, for --daemon: seconds between syncs of each account (can also be
+; set per account), +/- a random fraction sync_jitter of it; failed syncs are
+; retried after retry_delay, doubling up to max_backoff; status_port serves
+; the schedule as JSON on localhost
+sync_interval = 3600
+sync_jitter = 0.1
+retry_delay = 300
+max_backoff = 86400
+status_port = 8765
+; optional: cache balances responses on disk for cache_ttl_balances seconds
+; (0 to not cache them), keeping at most cache_max_entries responses
+cache_file = /data/plaid-cache.db
+cache_ttl_balances = 900
+cache_max_entries = 1000
+; optional, for --shard i/N: database file each shard writes to, later folded
+; into dbfile with --merge-shards ({shard} and {shards} are replaced; by default
+; dbfile with ".shard-<i>-of-<N>" before its extension)
+shard_dbfile = /data/transactions-{shard}-of-{shards}.db
 
 [Account1]
 access_token = access-development-xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
 account = xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
+; optional, for --daemon
+sync_interval = 900
 
 [Account2]
 ....
 """
 import configparser
+import hashlib
+import os
 import time
 import shutil
+from typing import Optional, Tuple
+
+
+def account_shard(account_name: str, shards: int) -> int:
+    """
+    The shard (1 to shards) account_name is synchronized by with --shard.
+    Uses a hash of the name that, unlike hash(), is the same in every process
+    and on every host.
+    """
+    digest = hashlib.sha256(account_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards + 1
 
 
 class Config:
@@ -32,11 +88,21 @@ class Config:
         self.config.read(config_file)
 
     def get_plaid_client_config(self) -> str:
+        page_fanout = self.config['PLAID'].getint('page_fanout', 4)
+        if page_fanout < 1:
+            raise ValueError("Invalid page_fanout [%d], must be at least 1" % page_fanout)
+
         return {
             'client_id': self.config['PLAID']['client_id'],
             'secret': self.config['PLAID']['secret'],
             'environment': self.config['PLAID'].get('environment', 'sandbox'),
             'suppress_warnings': self.config['PLAID'].get('suppress_warnings', True),
+            'page_fanout': page_fanout,
+            'base_url': self.config['PLAID'].get('base_url'),
+            'max_retries': self.config['PLAID'].getint('max_retries', 5),
+            'requests_per_second': self.config['PLAID'].getfloat('requests_per_second', 50) or None,
+            'connect_timeout': self.config['PLAID'].getfloat('connect_timeout', 10),
+            'read_timeout': self.config['PLAID'].getfloat('read_timeout', 600),
         }
 
     @property
@@ -46,6 +112,53 @@ class Config:
     def get_dbfile(self) -> str:
         return self.config['plaid-sync']['dbfile']
 
+    def get_shard_dbfile(self, shard: int, shards: int) -> str:
+        pattern = self.config['plaid-sync'].get('shard_dbfile')
+        if pattern:
+            return pattern.replace('{shard}', str(shard)).replace('{shards}', str(shards))
+        root, ext = os.path.splitext(self.get_dbfile())
+        return "%s.shard-%d-of-%d%s" % (root, shard, shards, ext)
+
+    def get_db_options(self) -> dict:
+        compression = self.config['plaid-sync'].get('compression', 'none').lower()
+        return {
+            'synchronous': self.config['plaid-sync'].get('sqlite_synchronous', 'NORMAL'),
+            'cache_size': self.config['plaid-sync'].getint('sqlite_cache_size', -16000),
+            'compression': compression if compression != 'none' else None,
+        }
+
+    def get_settle_days(self) -> int:
+        return self.config['plaid-sync'].getint('settle_days', 14)
+
+    def get_daemon_options(self) -> dict:
+        section = self.config['plaid-sync']
+        return {
+            'default_interval': section.getfloat('sync_interval', 3600),
+            'jitter': section.getfloat('sync_jitter', 0.1),
+            'retry_delay': section.getfloat('retry_delay', 300),
+            'max_backoff': section.getfloat('max_backoff', 86400),
+            'status_port': section.getint('status_port'),
+        }
+
+    def get_sync_interval(self, account_name: str, default: float) -> float:
+        return self.config[account_name].getfloat('sync_interval', default)
+
+    def get_response_cache_options(self) -> Optional[dict]:
+        """
+        Returns the ResponseCache arguments, or None if no cache_file is
+        configured.
+        """
+        section = self.config['plaid-sync']
+        if not section.get('cache_file'):
+            return None
+        return {
+            'path': section['cache_file'],
+            'ttls': {
+                'balances': section.getfloat('cache_ttl_balances', 900),
+            },
+            'max_entries': section.getint('cache_max_entries', 1000),
+        }
+
     def get_all_config_sections(self) -> str:
         """
         Returns all defined configuration sections, not just accounts
@@ -57,7 +170,11 @@ class Config:
             for account in self.config.sections()
         ]
 
-    def get_enabled_accounts(self) -> str:
+    def get_enabled_accounts(self, shard: Optional[Tuple[int, int]] = None) -> str:
+        """
+        Returns the names of all enabled accounts or, if shard is given as
+        (i, N), only those belonging to shard i of N.
+        """
         return [
             account
             for account in self.config.sections()
@@ -66,6 +183,7 @@ class Config:
                 and account != 'plaid-sync'
                 and 'access_token' in self.config[account]
                 and not self.config[account].getboolean('disabled', False)
+                and (not shard or account_shard(account, shard[1]) == shard[0])
             )
         ]
 
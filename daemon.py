@@ -0,0 +1,241 @@
+"""
+Long running mode for plaid-sync (--daemon): keeps the Plaid client and the
+database open, and synchronizes every enabled account on its own schedule.
+
+Each account runs every sync_interval seconds (from its configuration
+section, or [plaid-sync]), spread by a random jitter so accounts do not all
+hit Plaid at once. Failed runs are retried with exponential backoff, and
+accounts that need the user to update their credentials are only retried
+after max_backoff. The configuration file is re-read when it changes, so
+accounts can be added, disabled or rescheduled without a restart.
+
+Optionally, a small HTTP endpoint on localhost reports the schedule and the
+outcome of the last run of every account as JSON.
+"""
+
+import concurrent.futures
+import datetime
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+import config
+import plaidapi
+
+
+def timestamp(ts: Optional[float]) -> Optional[str]:
+    if ts is None:
+        return None
+    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc).isoformat()
+
+
+class AccountSchedule:
+    def __init__(self, account_name: str, interval: float, next_run: float):
+        self.account_name = account_name
+        self.interval     = interval
+        self.next_run     = next_run
+        self.running      = False
+        self.failures     = 0
+        self.last_started = None
+        self.last_finished = None
+        self.last_result  = None
+
+    def as_dict(self) -> Dict:
+        return {
+            'account': self.account_name,
+            'interval': self.interval,
+            'next_run': timestamp(self.next_run),
+            'running': self.running,
+            'failures': self.failures,
+            'last_started': timestamp(self.last_started),
+            'last_finished': timestamp(self.last_finished),
+            'last_result': self.last_result,
+        }
+
+
+class Scheduler:
+    def __init__(self, config_file: str, run_account: Callable, jobs: int = 1,
+                 default_interval: float = 3600, jitter: float = 0.1,
+                 retry_delay: float = 300, max_backoff: float = 86400,
+                 status_port: Optional[int] = None, shard: Optional[Tuple[int, int]] = None):
+        """
+        run_account(cfg, account_name) synchronizes one account and returns
+        its PlaidSynchronizer. Up to jobs accounts are synchronized at once.
+        If shard is given as (i, N), only the accounts of shard i of N are
+        scheduled.
+        """
+        self.config_file      = config_file
+        self.run_account      = run_account
+        self.jobs             = jobs
+        self.default_interval = default_interval
+        self.jitter           = jitter
+        self.retry_delay      = retry_delay
+        self.max_backoff      = max_backoff
+        self.status_port      = status_port
+        self.shard            = shard
+
+        self.cfg          = None
+        self.config_mtime = None
+        self.schedules: Dict[str, AccountSchedule] = {}
+        self.lock         = threading.Lock()
+        self.stopping     = threading.Event()
+        # set whenever a run finishes, to re-check what is due
+        self.wakeup       = threading.Event()
+
+    def jittered(self, seconds: float) -> float:
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reload_config(self, now: float):
+        """
+        Re-reads the configuration file if it changed since it was last read,
+        and brings the schedules in line with its enabled accounts.
+        """
+        mtime = os.stat(self.config_file).st_mtime
+        if mtime == self.config_mtime:
+            return
+
+        cfg = config.Config(self.config_file)
+        if self.cfg:
+            print("Configuration file changed, reloaded %s" % self.config_file, flush=True)
+        self.cfg, self.config_mtime = cfg, mtime
+
+        accounts = cfg.get_enabled_accounts(self.shard)
+        with self.lock:
+            for account_name in list(self.schedules):
+                if account_name not in accounts:
+                    print("%-50s: no longer enabled, unscheduled" % account_name, flush=True)
+                    del self.schedules[account_name]
+
+            for account_name in accounts:
+                interval = cfg.get_sync_interval(account_name, self.default_interval)
+                schedule = self.schedules.get(account_name)
+                if not schedule:
+                    # spread the first runs over the start of the interval
+                    self.schedules[account_name] = AccountSchedule(
+                        account_name, interval, now + random.uniform(0, interval * self.jitter))
+                elif schedule.interval != interval:
+                    schedule.next_run = min(schedule.next_run, now + self.jittered(interval))
+                    schedule.interval = interval
+
+    def run(self, schedule: AccountSchedule, cfg: config.Config):
+        started = time.time()
+        try:
+            sync   = self.run_account(cfg, schedule.account_name)
+            error  = sync.plaid_error
+            result = {
+                'counts': sync.counts._asdict(),
+                'skipped': sync.skipped,
+                'window': [str(d) for d in sync.window] if sync.window else None,
+                'metrics': sync.metrics.as_dict(),
+                'error': str(error) if error else None,
+            }
+        except Exception as ex:
+            error  = ex
+            result = {'error': "%s: %s" % (type(ex).__name__, ex)}
+        finished = time.time()
+
+        with self.lock:
+            schedule.running       = False
+            schedule.last_started  = started
+            schedule.last_finished = finished
+            schedule.last_result   = result
+
+            if not error:
+                schedule.failures = 0
+                delay = self.jittered(schedule.interval)
+            elif isinstance(error, plaidapi.PlaidAccountUpdateNeeded):
+                # nothing changes until the credentials are updated
+                schedule.failures += 1
+                delay = self.max_backoff
+            else:
+                schedule.failures += 1
+                delay = min(self.max_backoff, self.jittered(self.retry_delay * 2 ** (schedule.failures - 1)))
+            schedule.next_run = finished + delay
+
+        if error:
+            print("%-50s: failed (%s), retrying in %ds" % (schedule.account_name, result['error'], delay), flush=True)
+        elif result['skipped']:
+            print("%-50s: no new data from Plaid, next run in %ds" % (schedule.account_name, delay), flush=True)
+        else:
+            counts = result['counts']
+            print("%-50s: %2d new transactions (%d pending), %2d modified, %2d archived, next run in %ds" % (
+                schedule.account_name, counts['new'], counts['new_pending'], counts['modified'], counts['archived'], delay),
+                flush=True)
+        self.wakeup.set()
+
+    def status(self) -> Dict:
+        with self.lock:
+            return {
+                'config_file': self.config_file,
+                'now': timestamp(time.time()),
+                'accounts': [schedule.as_dict() for schedule in self.schedules.values()],
+            }
+
+    def start_status_server(self) -> ThreadingHTTPServer:
+        scheduler = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def log_request(self, code=None, size=None):
+                pass
+
+            def do_GET(self):
+                payload = json.dumps(scheduler.status(), indent=2).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", self.status_port), StatusHandler)
+        thread = threading.Thread(target=httpd.serve_forever, name="StatusServer", daemon=True)
+        thread.start()
+        print("Status available at http://127.0.0.1:%d/" % httpd.server_address[1], flush=True)
+        return httpd
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def serve_forever(self):
+        self.reload_config(time.time())
+        httpd = self.start_status_server() if self.status_port is not None else None
+        print("Scheduling %d accounts" % len(self.schedules), flush=True)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            try:
+                while not self.stopping.is_set():
+                    now = time.time()
+                    try:
+                        self.reload_config(now)
+                    except Exception as ex:
+                        print("Could not reload configuration, keeping the previous one: %s" % ex, flush=True)
+
+                    with self.lock:
+                        running = sum(1 for s in self.schedules.values() if s.running)
+                        due = sorted(
+                            (s for s in self.schedules.values() if not s.running and s.next_run <= now),
+                            key=lambda s: s.next_run,
+                        )[:max(0, self.jobs - running)]
+                        for schedule in due:
+                            schedule.running = True
+                        waiting = [s.next_run for s in self.schedules.values() if not s.running]
+
+                    for schedule in due:
+                        pool.submit(self.run, schedule, self.cfg)
+
+                    # wake up for the next due account, a finished run, or
+                    # at least every few seconds to notice config changes
+                    if running + len(due) >= self.jobs:
+                        timeout = 5.0
+                    else:
+                        timeout = min([5.0] + [max(0.0, t - now) for t in waiting])
+                    self.wakeup.wait(timeout)
+                    self.wakeup.clear()
+            finally:
+                print("Stopping, waiting for running accounts to finish", flush=True)
+                if httpd:
+                    httpd.shutdown()
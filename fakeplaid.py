@@ -0,0 +1,444 @@
+#!python
+"""
+A small local stand-in for the parts of the Plaid API that plaid-sync uses,
+so the sync process can be run and tested offline, without bank credentials.
+
+Implements /item/get, /accounts/balance/get, /transactions/get (with
+offset/count pagination and total_transactions) and /transactions/sync (with
+cursors), backed by in-memory data.
+
+Start it with:
+
+    python fakeplaid.py --port 4584
+
+or, for synthetic data at a larger scale and with simulated network latency:
+
+    python fakeplaid.py --port 4584 --items 20 --accounts 3 --transactions 5000 --days 730 --latency 0.1
+
+--rate-limit makes it answer RATE_LIMIT_EXCEEDED beyond a number of requests
+per second, like Plaid does.
+
+and point plaid-sync at it from the [PLAID] section of the configuration:
+
+    [PLAID]
+    client_id = fake
+    secret = fake
+    environment = sandbox
+    base_url = http://127.0.0.1:4584
+
+    [Fake Bank]
+    access_token = access-fake-0
+
+https://plaid.com/docs/api/
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional
+
+
+def iso8601_now() -> str:
+    # Plaid timestamps always carry milliseconds and a Z suffix
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return now.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (now.microsecond // 1000)
+
+
+class FakeItem:
+    """
+    One linked bank login: its accounts, current transactions and a log of
+    every change made to them. /transactions/sync cursors are positions in
+    that log. Every change counts as a new successful refresh of the item.
+    """
+    def __init__(self, item_id: str, accounts: List[Dict], transactions: List[Dict] = ()):
+        self.item_id      = item_id
+        self.accounts     = accounts
+        self.transactions = {}
+        self.changes      = []
+        self.error        = None
+        self.last_successful_update = iso8601_now()
+        self.last_failed_update     = "2000-01-01T00:00:00.000Z"
+
+        for transaction in transactions:
+            self.add_transaction(transaction)
+
+    def add_transaction(self, transaction: Dict):
+        self.transactions[transaction['transaction_id']] = transaction
+        self.changes.append(('added', transaction))
+        self.last_successful_update = iso8601_now()
+
+    def modify_transaction(self, transaction_id: str, **fields):
+        transaction = dict(self.transactions[transaction_id], **fields)
+        self.transactions[transaction_id] = transaction
+        self.changes.append(('modified', transaction))
+        self.last_successful_update = iso8601_now()
+
+    def remove_transaction(self, transaction_id: str):
+        del self.transactions[transaction_id]
+        self.changes.append(('removed', {'transaction_id': transaction_id}))
+        self.last_successful_update = iso8601_now()
+
+    def set_error(self, error_type: Optional[str], error_code: Optional[str] = None):
+        """
+        Makes every request for this item fail with the given Plaid error,
+        e.g. ('ITEM_ERROR', 'ITEM_LOGIN_REQUIRED'). Pass None to clear it.
+        """
+        self.error = (error_type, error_code) if error_type else None
+
+    def item_json(self) -> Dict:
+        return {
+            'item_id': self.item_id,
+            'institution_id': 'ins_fake',
+            'consent_expiration_time': None,
+            'available_products': [],
+            'billed_products': ['transactions'],
+            'error': None,
+            'webhook': '',
+        }
+
+
+class FakePlaidData:
+    """
+    All items served by the fake Plaid server, keyed by access token.
+    """
+    def __init__(self, latency: float = 0.0, rate_limit: Optional[int] = None):
+        self.items: Dict[str, FakeItem] = {}
+        self.lock = threading.Lock()
+        # seconds added to every response, to simulate network round-trips
+        self.latency = latency
+        # requests per second accepted before answering RATE_LIMIT_EXCEEDED
+        self.rate_limit = rate_limit
+        self.requests: Deque[float] = collections.deque()
+
+    def over_rate_limit(self) -> bool:
+        """
+        Records a request, returning True if it exceeds rate_limit over
+        the last second.
+        """
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.requests and self.requests[0] <= now - 1:
+                self.requests.popleft()
+            if len(self.requests) >= self.rate_limit:
+                return True
+            self.requests.append(now)
+            return False
+
+    def add_item(self, access_token: str, item: FakeItem):
+        self.items[access_token] = item
+
+
+def make_account(account_id: str, name: str, account_type: str = 'depository', subtype: str = 'checking') -> Dict:
+    return {
+        'account_id': account_id,
+        'name': name,
+        'official_name': name,
+        'type': account_type,
+        'subtype': subtype,
+        'mask': account_id[-4:],
+        'balances': {
+            'current': 1000.0,
+            'available': 1000.0,
+            'limit': None,
+            'iso_currency_code': 'USD',
+            'unofficial_currency_code': None,
+        },
+    }
+
+
+MERCHANTS = [
+    ('Starbucks',      ['Food and Drink', 'Restaurants', 'Coffee Shop']),
+    ('Whole Foods',    ['Shops', 'Supermarkets and Groceries']),
+    ('Shell',          ['Travel', 'Gas Stations']),
+    ('Amazon',         ['Shops', 'Digital Purchase']),
+    ('Uber',           ['Travel', 'Taxi']),
+    ('Netflix',        ['Service', 'Subscription']),
+    (None,             ['Transfer', 'Debit']),
+]
+
+
+def make_transaction(rng: random.Random, account_id: str, date: datetime.date, pending: bool = False) -> Dict:
+    merchant_name, category = rng.choice(MERCHANTS)
+    return {
+        'transaction_id': uuid.UUID(int=rng.getrandbits(128)).hex,
+        'account_id': account_id,
+        'account_owner': None,
+        'amount': round(rng.uniform(1, 250), 2),
+        'iso_currency_code': 'USD',
+        'unofficial_currency_code': None,
+        'category': category,
+        'category_id': '13005000',
+        'date': date.strftime("%Y-%m-%d"),
+        'authorized_date': None,
+        'location': {},
+        'merchant_name': merchant_name,
+        'name': (merchant_name or 'Transfer').upper(),
+        'payment_channel': 'in store',
+        'payment_meta': {},
+        'pending': pending,
+        'pending_transaction_id': None,
+        'transaction_code': None,
+        'transaction_type': 'place',
+    }
+
+
+def sample_data(seed: int = 0) -> FakePlaidData:
+    """
+    A single item (access token access-fake-0) with a checking and a credit
+    card account and about two months of transactions.
+    """
+    rng   = random.Random(seed)
+    today = datetime.date.today()
+
+    accounts = [
+        make_account('fake-checking-0001', 'Fake Checking'),
+        make_account('fake-credit-0002', 'Fake Credit Card', 'credit', 'credit card'),
+    ]
+    transactions = [
+        make_transaction(rng, account['account_id'], today - datetime.timedelta(days=day), pending=(day < 2))
+        for account in accounts
+        for day in range(60)
+    ]
+
+    data = FakePlaidData()
+    data.add_item('access-fake-0', FakeItem('fake-item-0', accounts, transactions))
+    return data
+
+
+def synthetic_data(items: int = 1, accounts: int = 2, transactions: int = 1000, days: int = 365,
+                   latency: float = 0.0, seed: int = 0) -> FakePlaidData:
+    """
+    Generated data for benchmarking: items (access tokens access-fake-0,
+    access-fake-1, ...) each with the given number of accounts, each account
+    with the given number of transactions spread over the last days.
+    """
+    rng   = random.Random(seed)
+    today = datetime.date.today()
+    data  = FakePlaidData(latency)
+
+    for i in range(items):
+        item_accounts = [
+            make_account('fake-%d-account-%04d' % (i, a), 'Fake Account %d' % a)
+            for a in range(accounts)
+        ]
+        item_transactions = [
+            make_transaction(rng, account['account_id'], today - datetime.timedelta(days=rng.randrange(days)))
+            for account in item_accounts
+            for _ in range(transactions)
+        ]
+        data.add_item('access-fake-%d' % i, FakeItem('fake-item-%d' % i, item_accounts, item_transactions))
+
+    return data
+
+
+class FakePlaidError(Exception):
+    def __init__(self, error_type: str, error_code: str, message: str):
+        super().__init__(message)
+        self.error_type = error_type
+        self.error_code = error_code
+        self.message    = message
+
+
+class FakePlaidHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests, like the real API
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, data: FakePlaidData, *args, **kwargs):
+        self.data = data
+        super().__init__(*args, **kwargs)
+
+    def log_request(self, code=None, size=None) -> None:
+        pass
+
+    def send_json(self, status: int, body: Dict):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.wfile.flush()
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        cl = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(cl) or b"{}")
+
+        routes = {
+            '/item/get': self.item_get,
+            '/accounts/balance/get': self.accounts_balance_get,
+            '/transactions/get': self.transactions_get,
+            '/transactions/sync': self.transactions_sync,
+        }
+
+        if self.data.latency:
+            time.sleep(self.data.latency)
+
+        try:
+            if self.data.over_rate_limit():
+                self.send_json(429, {
+                    'error_type': 'RATE_LIMIT_EXCEEDED',
+                    'error_code': 'RATE_LIMIT',
+                    'error_message': "rate limit exceeded",
+                    'display_message': None,
+                    'request_id': uuid.uuid4().hex,
+                    'causes': [],
+                })
+                return
+
+            if path not in routes:
+                raise FakePlaidError('INVALID_REQUEST', 'NOT_FOUND', "unknown endpoint %s" % path)
+
+            with self.data.lock:
+                response = routes[path](request)
+            response['request_id'] = uuid.uuid4().hex
+            self.send_json(200, response)
+        except FakePlaidError as ex:
+            self.send_json(400, {
+                'error_type': ex.error_type,
+                'error_code': ex.error_code,
+                'error_message': ex.message,
+                'display_message': None,
+                'request_id': uuid.uuid4().hex,
+                'causes': [],
+            })
+
+    def get_item(self, request: Dict) -> FakeItem:
+        item = self.data.items.get(request.get('access_token'))
+        if not item:
+            raise FakePlaidError('INVALID_INPUT', 'INVALID_ACCESS_TOKEN', "provided access token is in an invalid format")
+        if item.error:
+            raise FakePlaidError(item.error[0], item.error[1], "fake error set for item %s" % item.item_id)
+        return item
+
+    def item_get(self, request: Dict) -> Dict:
+        item = self.get_item(request)
+        return {
+            'item': item.item_json(),
+            'status': {
+                'transactions': {
+                    'last_successful_update': item.last_successful_update,
+                    'last_failed_update': item.last_failed_update,
+                },
+                'last_webhook': None,
+            },
+        }
+
+    def accounts_balance_get(self, request: Dict) -> Dict:
+        item = self.get_item(request)
+        return {
+            'accounts': item.accounts,
+            'item': item.item_json(),
+        }
+
+    def transactions_get(self, request: Dict) -> Dict:
+        item = self.get_item(request)
+        options = request.get('options') or {}
+        account_ids = options.get('account_ids')
+        offset = options.get('offset', 0)
+        count = options.get('count', 100)
+
+        matching = sorted(
+            (
+                t for t in item.transactions.values()
+                if request['start_date'] <= t['date'] <= request['end_date']
+                and (not account_ids or t['account_id'] in account_ids)
+            ),
+            key=lambda t: (t['date'], t['transaction_id']),
+            reverse=True,
+        )
+
+        return {
+            'accounts': item.accounts,
+            'item': item.item_json(),
+            'transactions': matching[offset:offset + count],
+            'total_transactions': len(matching),
+        }
+
+    def transactions_sync(self, request: Dict) -> Dict:
+        item = self.get_item(request)
+        cursor = request.get('cursor') or "0"
+        count = request.get('count', 100)
+
+        if not cursor.isdigit() or int(cursor) > len(item.changes):
+            raise FakePlaidError('INVALID_INPUT', 'INVALID_FIELD', "cursor is not valid")
+
+        start = int(cursor)
+        changes = item.changes[start:start + count]
+        end = start + len(changes)
+
+        return {
+            'added': [t for kind, t in changes if kind == 'added'],
+            'modified': [t for kind, t in changes if kind == 'modified'],
+            'removed': [t for kind, t in changes if kind == 'removed'],
+            'next_cursor': str(end),
+            'has_more': end < len(item.changes),
+        }
+
+
+def make_server(data: FakePlaidData, host: str = '127.0.0.1', port: int = 4584) -> ThreadingHTTPServer:
+    def make_handler(*args, **kwargs):
+        return FakePlaidHandler(data, *args, **kwargs)
+
+    return ThreadingHTTPServer((host, port), make_handler)
+
+
+def start(data: FakePlaidData, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """
+    Starts serving data on a background thread and returns the server; use
+    server.server_address for the actual port and server.shutdown() to stop
+    it. With port=0 a free port is picked.
+    """
+    httpd = make_server(data, host, port)
+    threading.Thread(target=httpd.serve_forever, name="fakeplaid", daemon=True).start()
+    return httpd
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Plaid API for offline testing of plaid-sync")
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="Address to listen on. Defaults to 127.0.0.1.")
+    parser.add_argument("--port", dest="port", type=int, default=4584, help="Port to listen on, 0 picks a free port. Defaults to 4584.")
+    parser.add_argument("--items", dest="items", type=int, help="If set, serve this many items of synthetic data instead of the small sample data set.")
+    parser.add_argument("--accounts", dest="accounts", type=int, default=2, help="Synthetic data: accounts per item. Defaults to 2.")
+    parser.add_argument("--transactions", dest="transactions", type=int, default=1000, help="Synthetic data: transactions per account. Defaults to 1000.")
+    parser.add_argument("--days", dest="days", type=int, default=365, help="Synthetic data: days of history transactions are spread over. Defaults to 365.")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0, help="Seconds of latency added to every response. Defaults to 0.")
+    parser.add_argument("--rate-limit", dest="rate_limit", type=int, help="If set, requests beyond this many per second are answered with RATE_LIMIT_EXCEEDED.")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Random seed for generated data. Defaults to 0.")
+    args = parser.parse_args()
+
+    if args.items:
+        data = synthetic_data(args.items, args.accounts, args.transactions, args.days, args.latency, args.seed)
+    else:
+        data = sample_data(args.seed)
+        data.latency = args.latency
+    data.rate_limit = args.rate_limit
+
+    with make_server(data, args.host, args.port) as httpd:
+        host, port = httpd.socket.getsockname()
+        print("Fake Plaid API listening on http://%s:%d" % (host, port))
+        if len(data.items) <= 10:
+            for access_token in data.items:
+                print("    access_token = %s" % access_token)
+        else:
+            print("    access_token = access-fake-0 ... access-fake-%d" % (len(data.items) - 1))
+        sys.stdout.flush()
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("Keyboard interrupt received, exiting.")
+            sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+JSON encoding and decoding for the hot paths (storing and loading Plaid
+payloads, hashing them, parsing API responses).
+
+Parsing and hashing use orjson when it is installed, which is several times
+faster, and the standard library json module otherwise. Hashed JSON is the
+same either way (compact, sorted, non-ASCII characters left as UTF-8), so
+content hashes do not change when orjson is installed or removed.
+
+JSON written to the database (dumps) is always formatted by json.dumps with
+its default options, byte for byte as plaid-sync has always stored it;
+orjson cannot produce that format.
+"""
+
+import json
+import re
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson else "json"
+
+# orjson and json format floats below 1e-4 or from 1e16 differently
+# ("0.00001" vs "1e-05", "1e16" vs "1e+16"). Output that may contain such a
+# number - rarely, if ever, the case for Plaid data - is encoded with json
+# instead. Strings that happen to match only cost the slower path. The
+# exponent check starts at the literal "e" and requires the number to end
+# there, which keeps it cheap on payloads full of hex ids.
+_EXPONENT = re.compile(rb"e-?[0-9]+(?:[,}\]]|$)")
+
+
+def canonical_dumps(obj: Any) -> bytes:
+    """
+    UTF-8 encoded JSON with sorted keys, for hashing.
+    """
+    if orjson:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+            if b"0.0000" not in data and not _EXPONENT.search(data):
+                return data
+        except TypeError:
+            # e.g. integers beyond 64 bits, which json handles
+            pass
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def dumps(obj: Any) -> str:
+    return json.dumps(obj)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,169 @@
+"""
+Per-account timing and counters for sync runs.
+
+Each PlaidSynchronizer owns a SyncMetrics, and activates it while it runs.
+Code further down (PlaidAPI, TransactionsDB) records into whichever metrics
+are active for the current thread/context through the module level count()
+and timer() helpers, so it does not need to be handed the metrics object.
+
+At the end of a run the collected metrics can be written out as JSON or as
+a Prometheus textfile collector file:
+
+https://github.com/prometheus/node_exporter#textfile-collector
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List
+
+_current = contextvars.ContextVar("plaid_sync_metrics", default=None)
+
+
+class SyncMetrics:
+    def __init__(self, account_name: str):
+        self.account_name = account_name
+        self.phases       = defaultdict(float)
+        self.counters     = defaultdict(int)
+        self.lock         = threading.Lock()
+
+    def add_time(self, phase: str, seconds: float):
+        with self.lock:
+            self.phases[phase] += seconds
+
+    def count(self, counter: str, n: int = 1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def as_dict(self) -> Dict:
+        with self.lock:
+            return {
+                'account': self.account_name,
+                'phases': dict(self.phases),
+                'counters': dict(self.counters),
+            }
+
+
+@contextlib.contextmanager
+def activate(metrics: SyncMetrics):
+    """
+    Makes metrics the target of count() and timer() in the current context.
+    """
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def count(counter: str, n: int = 1):
+    metrics = _current.get()
+    if metrics:
+        metrics.count(counter, n)
+
+
+@contextlib.contextmanager
+def timer(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current.get()
+        if metrics:
+            metrics.add_time(phase, time.perf_counter() - start)
+
+
+def timed_iter(phase: str, iterable: Iterable) -> Iterator:
+    """
+    Yields from iterable, adding the time spent waiting for each item to
+    phase.
+    """
+    iterator = iter(iterable)
+    while True:
+        with timer(phase):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def submit(pool, fn, *args, **kwargs):
+    """
+    pool.submit that runs fn with the submitting thread's active metrics
+    (context variables are not inherited by executor threads).
+    """
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def write_json(path: str, report: Dict):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def write_prometheus(path: str, report: Dict):
+    """
+    Writes report in the Prometheus text exposition format. The file is
+    written next to path and renamed into place, so the textfile collector
+    never reads a partial file.
+    """
+    lines = [
+        "# HELP plaid_sync_last_run_timestamp_seconds When the last sync run finished.",
+        "# TYPE plaid_sync_last_run_timestamp_seconds gauge",
+        "plaid_sync_last_run_timestamp_seconds %f" % report['finished'],
+        "# HELP plaid_sync_run_duration_seconds Wall time of the last sync run.",
+        "# TYPE plaid_sync_run_duration_seconds gauge",
+        "plaid_sync_run_duration_seconds %f" % report['duration'],
+        "# HELP plaid_sync_phase_seconds Time spent per account and sync phase in the last run.",
+        "# TYPE plaid_sync_phase_seconds gauge",
+    ]
+    for account in report['accounts']:
+        for phase, seconds in sorted(account['phases'].items()):
+            lines.append('plaid_sync_phase_seconds{account="%s",phase="%s"} %f' % (
+                escape_label(account['account']), escape_label(phase), seconds))
+
+    counter_names = sorted(set(
+        name
+        for account in report['accounts']
+        for name in account['counters']
+    ))
+    for name in counter_names:
+        lines.append("# TYPE plaid_sync_%s gauge" % name)
+        for account in report['accounts']:
+            if name in account['counters']:
+                lines.append('plaid_sync_%s{account="%s"} %d' % (
+                    name, escape_label(account['account']), account['counters'][name]))
+
+    lines.append("# HELP plaid_sync_transactions Transactions per account and sync result (new, modified, archived, ...) in the last run.")
+    lines.append("# TYPE plaid_sync_transactions gauge")
+    for account in report['accounts']:
+        for kind, value in sorted(account.get('counts', {}).items()):
+            lines.append('plaid_sync_transactions{account="%s",kind="%s"} %d' % (
+                escape_label(account['account']), escape_label(kind), value))
+
+    lines.append("# HELP plaid_sync_error Whether the last sync of the account ended with a Plaid error.")
+    lines.append("# TYPE plaid_sync_error gauge")
+    for account in report['accounts']:
+        lines.append('plaid_sync_error{account="%s"} %d' % (escape_label(account['account']), 1 if account.get('error') else 0))
+
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def build_report(started: float, finished: float, accounts: List[Dict]) -> Dict:
+    return {
+        'started': started,
+        'finished': finished,
+        'duration': finished - started,
+        'accounts': accounts,
+    }
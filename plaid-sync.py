@@ -1,15 +1,25 @@
 #!.env/bin/python
 
 import argparse
+import concurrent.futures
+import contextvars
 import datetime
 from datetime import tzinfo
+import os
+import signal
 import sys
+import time
+import uuid
 from collections import namedtuple
 
 import config
-import plaidapi
+import metrics
 import transactionsdb
-from plaidapi import PlaidAccountUpdateNeeded, PlaidError
+
+# plaidapi, asyncplaidapi, responsecache, daemon and asyncio are imported
+# where they are used: they pull in the Plaid SDK and an HTTP client, which
+# the --report commands do not need and would spend most of their run time
+# importing
 
 
 def parse_options():
@@ -21,23 +31,73 @@ def parse_options():
         except:
             parser.error("Cannot parse [%s] as valid YYYY-MM-DD date" % value)
 
+    def valid_shard(value):
+        try:
+            shard, shards = (int(v) for v in value.split("/"))
+        except ValueError:
+            parser.error("Cannot parse [%s] as a shard, expected i/N" % value)
+        if not 1 <= shard <= shards:
+            parser.error("Shard [%s] must be between 1/%d and %d/%d" % (value, shards, shards, shards))
+        return shard, shards
+
     parser.add_argument("-v", "--verbose",    dest="verbose",        action='store_true',  help="If set, status messages will be output during sync process.")
     parser.add_argument("-c", "--config",     dest="config_file",    required=True,        help="[REQUIRED] Configuration filename", metavar="CONFIG_FILE")
     parser.add_argument("-b", "--balances",   dest="balances",       action='store_true',  help="If true, updated balance information (slow) is loaded. Defaults to false.")
-    parser.add_argument("-s", "--start_date", dest="start_date",     type=valid_date,      help="[YYYY-MM-DD] Start date for querying transactions. If ommitted, 30 days ago is used.")
-    parser.add_argument("-e", "--end_date",   dest="end_date",       type=valid_date,      help="[YYYY-MM-DD] End date for querying transactions. If ommitted, tomorrow is used.")
+    parser.add_argument("-s", "--start_date", dest="start_date",     type=valid_date,      help="[YYYY-MM-DD] Start date for querying transactions. If ommitted, each account starts at its oldest pending "
+                                                                                                "transaction or settle_days before its newest posted one (30 days ago if it has none yet).")
+    parser.add_argument("-e", "--end_date",   dest="end_date",       type=valid_date,      help="[YYYY-MM-DD] End date for querying transactions. If ommitted, today is used.")
+    parser.add_argument("--incremental",      dest="incremental",    action='store_true',  help="If set, only transactions changed since the last run are fetched, using Plaid's /transactions/sync. "
+                                                                                                "Accounts without a stored sync cursor have their full history synchronized once to start one.")
+    parser.add_argument("-j", "--jobs",       dest="jobs",           type=int, default=1,  help="Number of accounts to synchronize concurrently. Defaults to 1.")
+    parser.add_argument("--batch-size",       dest="batch_size",     type=int,             help="If set, transactions are streamed from Plaid and new ones saved in batches of this size, "
+                                                                                                "instead of holding the whole date range in memory.")
+    parser.add_argument("--backfill",         dest="backfill",       action='store_true',  help="If set, the date range is synchronized one month at a time, saving each month as it completes. "
+                                                                                                "An interrupted backfill resumes at the first month that did not complete.")
+    parser.add_argument("--backfill-jobs",    dest="backfill_jobs",  type=int, default=1,  help="Number of months fetched concurrently per account during --backfill. Defaults to 1.")
+    parser.add_argument("-f", "--force",      dest="force",          action='store_true',  help="If set, transactions are fetched even for items Plaid has not refreshed since their last sync.")
+    parser.add_argument("--no-cache",         dest="no_cache",       action='store_true',  help="If set, the balances response cache (cache_file) is not used for this run.")
+    parser.add_argument("--metrics-json",     dest="metrics_json",                         help="If set, per-account phase timings and counters of the run are written to this file as JSON.",
+                                                                                                metavar="FILE")
+    parser.add_argument("--metrics-prom",     dest="metrics_prom",                         help="If set, the same metrics are written to this file in Prometheus text format, "
+                                                                                                "e.g. for node_exporter's textfile collector.", metavar="FILE")
+    parser.add_argument("--async",            dest="use_async",      action='store_true',  help="If set, accounts are synchronized on a single asyncio event loop instead of one thread each (requires aiohttp); "
+                                                                                                "--jobs is then the number of accounts in flight at once. Not supported with --incremental, --backfill, --batch-size, "
+                                                                                                "--daemon, --update-account or --link-account.")
+    parser.add_argument("--daemon",           dest="daemon",         action='store_true',  help="If set, keep running and synchronize every account on its own sync_interval, until interrupted.")
+    parser.add_argument("--status-port",      dest="status_port",    type=int,             help="--daemon: serve the schedule and last results as JSON on this localhost port. Overrides status_port in the configuration.")
+    parser.add_argument("--shard",            dest="shard",          type=valid_shard,     help="[i/N] Only synchronize the accounts of shard i of N (assigned by a hash of the account name), "
+                                                                                                "into that shard's own database (shard_dbfile). Fold the shards back in with --merge-shards.")
+    parser.add_argument("--merge-shards",     dest="merge_shards",   nargs='+',            help="Merge these shard databases into dbfile, and exit.", metavar="SHARD_DBFILE")
+    parser.add_argument("--report",           dest="report",         choices=REPORTS,      help="Print the items' sync status, the latest balances or the transaction counts per account "
+                                                                                                "from the database, without contacting Plaid, and exit.")
+    parser.add_argument("--rebuild-rollups",  dest="rebuild_rollups", action='store_true', help="Regenerate the daily_rollups table from the stored transactions, and exit.")
+    parser.add_argument("--recompress",       dest="recompress",     action='store_true',  help="Rewrite the stored Plaid JSON with the configured compression (or uncompressed, if none), report the space saved, and exit.")
     parser.add_argument("--update-account",   dest="update_account",                       help="Specify the name of the account to run the update process for."
                                                                                                 "To be used when Plaid returns an error that credetials are out of date for an account.")
     parser.add_argument("--link-account",     dest="link_account",                         help="Run with this option to set up an entirely new account through Plaid.")
     args = parser.parse_args()
 
-    if not args.start_date:
-        args.start_date = (datetime.datetime.now() - datetime.timedelta(days=30)).date()
+    if args.jobs < 1:
+        parser.error("Number of jobs [%d] must be at least 1" % args.jobs)
+
+    if args.backfill_jobs < 1:
+        parser.error("Number of backfill jobs [%d] must be at least 1" % args.backfill_jobs)
 
-    if not args.end_date:
-        args.end_date = datetime.datetime.now().date()
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("Batch size [%d] must be at least 1" % args.batch_size)
 
-    if args.end_date < args.start_date:
+    if args.use_async:
+        if args.incremental or args.backfill or args.batch_size or args.daemon or args.update_account or args.link_account:
+            parser.error("--async cannot be combined with --incremental, --backfill, --batch-size, --daemon, "
+                         "--update-account or --link-account")
+        import asyncplaidapi
+        if asyncplaidapi.aiohttp is None:
+            parser.error("--async requires the aiohttp package")
+
+    if args.shard and args.merge_shards:
+        parser.error("--shard cannot be combined with --merge-shards")
+
+    if args.start_date and args.end_date and args.end_date < args.start_date:
         parser.error("End date [%s] cannot be before start date [%s]" % ( args.end_date, args.start_date ) )
         sys.exit(1)
 
@@ -48,6 +108,7 @@ class SyncCounts(
         namedtuple("SyncCounts", [
             "new",
             "new_pending",
+            "modified",
             "archived",
             "archived_pending",
             "total_fetched",
@@ -56,9 +117,48 @@ class SyncCounts(
     pass
 
 
+def result_of(future):
+    """
+    The result of future, or None if there is no future. A value that is not
+    a future (e.g. balances the async sync has already awaited) is returned
+    as it is.
+    """
+    return future.result() if isinstance(future, concurrent.futures.Future) else future
+
+
+def changes_not_removed(delta):
+    """
+    Returns the added, and the added and modified, transactions of delta,
+    leaving out any that delta also removes, so they are not saved as active.
+    """
+    removed = set(delta.removed)
+    added   = [t for t in delta.added if t.transaction_id not in removed]
+    return added, added + [t for t in delta.modified if t.transaction_id not in removed]
+
+
+def month_windows(start_date, end_date):
+    """
+    Splits start_date..end_date (inclusive) into calendar month windows,
+    returned as (start, end) date pairs.
+    """
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        next_month = (window_start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        window_end = min(next_month - datetime.timedelta(days=1), end_date)
+        windows.append((window_start, window_end))
+        window_start = next_month
+    return windows
+
+
+# days synchronized for an account with no stored transactions, unless a
+# start date is given
+DEFAULT_SYNC_DAYS = 30
+
+
 class PlaidSynchronizer:
     def __init__(self, db: transactionsdb.TransactionsDB,
-                 plaid: plaidapi.PlaidAPI, account_name: str,
+                 plaid: 'plaidapi.PlaidAPI', account_name: str,
                  access_token: str):
         self.transactions = {}
         self.db           = db
@@ -67,7 +167,12 @@ class PlaidSynchronizer:
         self.access_token = access_token
         self.plaid_error  = None
         self.item_info    = None
-        self.counts       = SyncCounts(0,0,0,0,0,0)
+        self.account_ids  = set()
+        self.sync_key     = uuid.uuid4().hex
+        self.counts       = SyncCounts(0,0,0,0,0,0,0)
+        self.skipped      = False
+        self.window       = None
+        self.metrics      = metrics.SyncMetrics(account_name)
 
     def add_transactions(self, transactions):
         self.transactions.update(
@@ -78,76 +183,566 @@ class PlaidSynchronizer:
     def count_pending(self, tids):
         return len([tid for tid in tids if self.transactions.get(tid) and self.transactions[tid].pending])
 
-    def sync(self, start_date, end_date, fetch_balances=True, verbose=False):
-        try:
-            if verbose:
-                print("Account: %s" % self.account_name)
-                print("    Fetching item (bank login) info")
-            self.item_info = self.plaid.get_item_info(self.access_token)
-
-            balances = None
-            if fetch_balances:
+    def sync(self, start_date, end_date, fetch_balances=True, verbose=False, batch_size=None, incremental=False,
+             backfill=False, backfill_jobs=1, force=False, settle_days=14):
+        """
+        Fetches item info, balances (if fetch_balances) and all transactions
+        between start_date and end_date, and brings the database in line with
+        them.
+
+        If start_date is None, it is worked out for this item from the
+        database; see window_start. The range used is kept in self.window.
+
+        If batch_size is set, transactions are streamed from Plaid page by
+        page and new ones are written in batches of batch_size, instead of
+        being collected in memory first.
+
+        If incremental is set and a /transactions/sync cursor is stored for
+        the item, only the changes since that cursor are fetched instead,
+        regardless of the date range. Without a cursor the item's full
+        history is synchronized once to establish one; see start_cursor.
+
+        If backfill is set, the date range is synchronized one month at a
+        time instead; see backfill_transactions.
+
+        Unless force (or backfill) is set, transactions are not fetched at all
+        if Plaid has not refreshed the item since its last complete sync;
+        only item info and balances are saved then, and self.skipped is set.
+
+        Balances are fetched alongside the item info, as they do not depend
+        on it. With a fixed date range (start_date given and force set,
+        without incremental, backfill or batch_size) so are the
+        transactions; otherwise the item info decides whether and which
+        transactions are fetched.
+
+        Time spent per phase and API/database counters are collected in
+        self.metrics.
+        """
+        import plaidapi
+
+        with metrics.activate(self.metrics), metrics.timer("total"):
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+            try:
                 if verbose:
-                    print("     Fetching current balances")
-                balances = self.plaid.get_account_balance(self.access_token)
+                    print("Account: %s" % self.account_name)
 
-            if verbose:
-                print("    Fetching transactions from %s to %s" % (start_date, end_date))
+                balances = None
+                if fetch_balances:
+                    balances = metrics.submit(pool, self.fetch_balances, verbose)
+
+                prefetched = None
+                if start_date and force and not (incremental or backfill or batch_size):
+                    self.window = (start_date, end_date)
+                    prefetched = metrics.submit(pool, self.fetch_transactions, start_date, end_date, verbose)
 
-            self.add_transactions(self.plaid.get_transactions(
+                if verbose:
+                    print("    Fetching item (bank login) info")
+                with metrics.timer("item_info"):
+                    self.item_info = self.plaid.get_item_info(self.access_token)
+
+                if prefetched:
+                    self.sync_transactions(start_date, end_date, balances, verbose, fetched=prefetched)
+                    return
+
+                if self.skip_unchanged(force or backfill, verbose):
+                    self.save_skipped(balances)
+                    return
+
+                if incremental and not backfill:
+                    self.window = None
+                    cursor = self.db.get_item_cursor(self.item_info.item_id)
+                    if cursor:
+                        self.sync_transactions_delta(cursor, balances, verbose)
+                    else:
+                        self.start_cursor(balances, verbose)
+                    return
+
+                start_date, end_date = self.plan_window(start_date, end_date, settle_days if not backfill else None)
+
+                if backfill:
+                    self.backfill_transactions(start_date, end_date, balances, backfill_jobs, verbose, settle_days)
+                    return
+
+                if batch_size:
+                    self.sync_transactions_streaming(start_date, end_date, balances, batch_size, verbose)
+                else:
+                    self.sync_transactions(start_date, end_date, balances, verbose)
+
+            except plaidapi.PlaidError as ex:
+                self.record_plaid_error(ex)
+            finally:
+                # after an error, requests still in flight are left to finish
+                # in the background and their results dropped
+                pool.shutdown(wait=False)
+
+    def fetch_balances(self, verbose=False):
+        if verbose:
+            print("    Fetching current balances")
+        with metrics.timer("balances"):
+            return self.plaid.get_account_balance(self.access_token)
+
+    def fetch_transactions(self, start_date, end_date, verbose=False):
+        if verbose:
+            print("    Fetching transactions from %s to %s" % (start_date, end_date))
+        with metrics.timer("fetch_transactions"):
+            return self.plaid.get_transactions(
                 access_token    = self.access_token,
                 start_date      = start_date,
                 end_date        = end_date,
-                status_callback = (lambda c,t: print("        %d/%d fetched" % ( c, t ) )) if verbose else None
-            ) )
+                status_callback = self.status_callback(verbose)
+            )
 
-            account_ids     = set( t.account_id for t in self.transactions.values() )
-            tids_existing   = set( self.db.get_transaction_ids( start_date, end_date, list(account_ids) ) )
-            tids_fetched    = set( self.transactions.keys() )
-            tids_new        = tids_fetched .difference( tids_existing )
-            tids_to_archive = tids_existing.difference( tids_fetched  )
+    def window_start(self, end_date, settle_days=None):
+        """
+        The start date for syncing this item: its oldest pending transaction,
+        or settle_days before its newest posted transaction - anything older
+        has settled and will not change any more. Falls back to
+        DEFAULT_SYNC_DAYS before today without stored transactions, or if
+        settle_days is None.
+        """
+        start_date = None
+        if settle_days is not None:
+            start_date = self.db.get_item_window_start(self.item_info.item_id, settle_days)
+        if not start_date:
+            start_date = datetime.date.today() - datetime.timedelta(days=DEFAULT_SYNC_DAYS)
+        return min(start_date, end_date)
+
+    def item_unchanged(self):
+        """
+        True if the item's last successful Plaid refresh is the one its
+        transactions were last synchronized with.
+        """
+        refreshed = self.item_info.ts_last_successful_update
+        synced    = self.db.get_item_synced_update(self.item_info.item_id)
+        return refreshed is not None and synced is not None and refreshed <= synced
+
+    def skip_unchanged(self, force, verbose=False):
+        """
+        Decides whether to skip this item's transactions: unless force is
+        set, they are skipped if the item is unchanged (see item_unchanged).
+        """
+        if force or not self.item_unchanged():
+            return False
+        if verbose:
+            print("    No Plaid refresh since the last sync (%s), skipping transactions" % self.item_info.ts_last_successful_update)
+        self.skipped = True
+        metrics.count("skipped_unchanged")
+        return True
+
+    def save_skipped(self, balances):
+        """
+        Saves the item info and balances (a future, a list or None) of an
+        item whose transactions are skipped.
+        """
+        with metrics.timer("write"):
+            self.db.save_account_sync(self.item_info, result_of(balances), [], [])
+
+    def plan_window(self, start_date, end_date, settle_days=None):
+        """
+        Returns the (start, end) range to synchronize, also kept in
+        self.window: from start_date, or if that is None from window_start.
+        """
+        self.window = (start_date or self.window_start(end_date, settle_days), end_date)
+        return self.window
+
+    def record_plaid_error(self, ex):
+        self.plaid_error = ex
+        # don't keep serving the item's balances from before the error
+        self.plaid.invalidate_cache(self.access_token)
+
+    def status_callback(self, verbose):
+        return (lambda c,t: print("        %d/%d fetched" % ( c, t ) )) if verbose else None
+
+    def sync_transactions(self, start_date, end_date, balances, verbose=False, backfill_window=False, fetched=None,
+                          checkpoint=True):
+        """
+        balances is a future of the balances to save along with the
+        transactions, or None. fetched is a future of the transactions if
+        they are already being fetched. backfill_window and checkpoint are
+        passed on to save_fetched_transactions.
+        """
+        if fetched:
+            transactions = fetched.result()
+        else:
+            transactions = self.fetch_transactions(start_date, end_date, verbose)
+        self.save_fetched_transactions(start_date, end_date, transactions, balances, verbose, backfill_window, checkpoint)
+
+    def save_fetched_transactions(self, start_date, end_date, transactions, balances, verbose=False, backfill_window=False,
+                                  checkpoint=True):
+        """
+        Diffs transactions, fetched for start_date..end_date, against the
+        database and saves the changes together with balances (a future, or
+        None).
+
+        If backfill_window is set, the range is one window of a backfill: it
+        does not count as a complete sync of the item, and is recorded as a
+        completed backfill window if checkpoint is set.
+        """
+        self.add_transactions(transactions)
+
+        account_ids   = set( t.account_id for t in self.transactions.values() )
+        total_fetched = len(self.transactions)
+        self.account_ids.update(account_ids)
+
+        # the diff against the database is computed in SQLite
+        with metrics.timer("diff"):
+            try:
+                tids_new, tids_modified = self.db.stage_transactions( self.sync_key, start_date, end_date, list(self.transactions.values()) )
+                tids_to_archive         = self.db.get_unstaged_transaction_ids( self.sync_key, start_date, end_date )
+            finally:
+                self.db.clear_staging(self.sync_key)
 
             self.add_transactions( self.db.fetch_transactions_by_id(tids_to_archive) )
 
-            self.counts = SyncCounts(
-                new              = len(tids_new),
-                new_pending      = self.count_pending(tids_new),
-                archived         = len(tids_to_archive),
-                archived_pending = self.count_pending(tids_to_archive),
-                total_fetched    = len(tids_fetched),
-                accounts         = len(account_ids),
+        self.counts = SyncCounts(
+            new              = len(tids_new),
+            new_pending      = self.count_pending(tids_new),
+            modified         = len(tids_modified),
+            archived         = len(tids_to_archive),
+            archived_pending = self.count_pending(tids_to_archive),
+            total_fetched    = total_fetched,
+            accounts         = len(account_ids),
+        )
+
+        self.print_counts(verbose)
+        balances = result_of(balances)
+
+        if verbose:
+            print("    Archiving %d transactions" % (len(tids_to_archive)))
+            print("    Saving %d balances, %d transactions" % (len(balances or []), len(tids_new) + len(tids_modified)))
+
+        # archive and inserts for this account are committed together,
+        # unchanged transactions are not written at all
+        with metrics.timer("write"):
+            self.db.save_account_sync(
+                item_info               = self.item_info,
+                balances                = balances,
+                transactions            = [self.transactions[tid] for tid in tids_new + tids_modified],
+                archive_transaction_ids = tids_to_archive,
+                backfill_window         = (start_date, end_date) if backfill_window and checkpoint else None,
+                synced_update           = None if backfill_window else self.item_info.ts_last_successful_update,
+                account_ids             = account_ids,
             )
 
-            if verbose:
-                print("    Fetched %d new (%d pending), %d to archive (%d were pending), %d total transactions from %d accounts" % (
-                    self.counts.new,
-                    self.counts.new_pending,
-                    self.counts.archived,
-                    self.counts.archived_pending,
-                    self.counts.total_fetched,
-                    self.counts.accounts
-                ))
+    def sync_transactions_streaming(self, start_date, end_date, balances, batch_size, verbose=False):
+        """
+        Like sync_transactions, but pages are diffed and new or modified
+        transactions written as they arrive, in batches of batch_size. Fetched
+        IDs are staged in the database for the archive decision once the
+        whole range has been fetched, so memory use does not grow with the
+        size of the range.
+
+        Batches are committed as they fill up; archiving, item info and
+        balances are saved together with the last batch, and only once every
+        page has been fetched successfully.
+        """
+        account_ids = set()
+        new         = 0
+        new_pending = 0
+        modified    = 0
+        batch       = []
+
+        if verbose:
+            print("    Fetching transactions from %s to %s" % (start_date, end_date))
 
-            if verbose:
-                print("    Archiving %d transactions" % (len(tids_to_archive)))
+        try:
+            for page in metrics.timed_iter("fetch_transactions", self.plaid.iter_transaction_pages(
+                    access_token    = self.access_token,
+                    start_date      = start_date,
+                    end_date        = end_date,
+                    status_callback = self.status_callback(verbose))):
+
+                account_ids.update( t.account_id for t in page )
+
+                with metrics.timer("diff"):
+                    tids_new, tids_modified = self.db.stage_transactions( self.sync_key, start_date, end_date, page )
+                page_by_id = dict( (t.transaction_id, t) for t in page )
+
+                new         += len(tids_new)
+                new_pending += len([tid for tid in tids_new if page_by_id[tid].pending])
+                modified    += len(tids_modified)
+                batch       += [page_by_id[tid] for tid in tids_new + tids_modified]
+
+                if len(batch) >= batch_size:
+                    if verbose:
+                        print("    Saving %d transactions" % len(batch))
+                    with metrics.timer("write"):
+                        self.db.save_transactions(batch, self.item_info.item_id)
+                    batch = []
+
+            with metrics.timer("diff"):
+                tids_to_archive = self.db.get_unstaged_transaction_ids( self.sync_key, start_date, end_date )
+        finally:
+            total_fetched = self.db.clear_staging(self.sync_key)
+
+        self.counts = SyncCounts(
+            new              = new,
+            new_pending      = new_pending,
+            modified         = modified,
+            archived         = len(tids_to_archive),
+            archived_pending = len([t for t in self.db.fetch_transactions_by_id(tids_to_archive) if t.pending]),
+            total_fetched    = total_fetched,
+            accounts         = len(account_ids),
+        )
 
-            if len(tids_to_archive) > 0:
-                self.db.archive_transactions(list(tids_to_archive))
+        self.print_counts(verbose)
+        balances = result_of(balances)
+
+        if verbose:
+            print("    Archiving %d transactions" % (len(tids_to_archive)))
+            print("    Saving %d balances, %d transactions" % (len(balances or []), len(batch)))
+
+        with metrics.timer("write"):
+            self.db.save_account_sync(
+                item_info               = self.item_info,
+                balances                = balances,
+                transactions            = batch,
+                archive_transaction_ids = tids_to_archive,
+                synced_update           = self.item_info.ts_last_successful_update,
+                account_ids             = account_ids,
+            )
 
+    def backfill_transactions(self, start_date, end_date, balances, jobs=1, verbose=False, settle_days=14):
+        """
+        Synchronizes start_date..end_date one calendar month at a time, with
+        up to jobs months being fetched at once.
+
+        Each month is saved as soon as it has been fetched, together with a
+        checkpoint for it. Months that already have a checkpoint are skipped,
+        so an interrupted backfill resumes where it left off rather than
+        starting over. Months ending within settle_days of today can still
+        change, so they are saved without a checkpoint and fetched again by
+        the next backfill.
+        """
+        completed = self.db.get_completed_backfill_windows(self.item_info.item_id)
+        windows   = [ w for w in month_windows(start_date, end_date) if w not in completed ]
+
+        if verbose:
+            print("    Backfilling %d of %d months from %s to %s" % (
+                len(windows), len(month_windows(start_date, end_date)), start_date, end_date))
+
+        self.db.save_item_info(self.item_info)
+        balances = result_of(balances)
+        if balances:
+            self.db.save_balances(self.item_info.item_id, balances)
+
+        settled = datetime.date.today() - datetime.timedelta(days=settle_days)
+
+        def sync_window(window):
+            # every window gets its own synchronizer, so only one window's
+            # transactions are held in memory per worker
+            sync = PlaidSynchronizer(self.db, self.plaid, self.account_name, self.access_token)
+            sync.item_info = self.item_info
             if verbose:
-                print("    Saving %d balances, %d transactions" % (len(balances), len(tids_new)))
+                print("    Fetching transactions from %s to %s" % window)
+            sync.sync_transactions(window[0], window[1], None, verbose, backfill_window=True, checkpoint=window[1] < settled)
+            return sync
+
+        def add_counts(sync):
+            window_counts.append(sync.counts)
+            self.account_ids.update(sync.account_ids)
+
+        window_counts = []
+        if jobs == 1:
+            # a plain TransactionsDB can only be used from this thread
+            for window in windows:
+                add_counts(sync_window(window))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                # the windows record into this account's metrics
+                futures = [metrics.submit(pool, sync_window, window) for window in windows]
+                for future in futures:
+                    add_counts(future.result())
+
+        self.counts = SyncCounts(*(
+            sum(counts) for counts in zip(SyncCounts(0,0,0,0,0,0,0), *window_counts)
+        ))._replace(accounts=len(self.account_ids))
+
+    def sync_transactions_delta(self, cursor, balances, verbose=False):
+        """
+        Applies the transactions added, modified and removed since cursor:
+        added and modified transactions are saved, removed ones archived, and
+        the new cursor is stored in the same database transaction.
+        """
+        if verbose:
+            print("    Fetching transaction changes since last sync")
+
+        with metrics.timer("fetch_transactions"):
+            delta = self.plaid.get_transactions_delta(self.access_token, cursor)
+        added, changed = changes_not_removed(delta)
+
+        # removed transactions that were never stored, or are archived
+        # already, are left out of the counts
+        to_archive = self.db.fetch_transactions_by_id(delta.removed, active_only=True)
+        self.add_transactions( changed )
+        self.add_transactions( to_archive )
+
+        self.counts = SyncCounts(
+            new              = len(added),
+            new_pending      = len([t for t in added if t.pending]),
+            modified         = len(changed) - len(added),
+            archived         = len(to_archive),
+            archived_pending = len([t for t in to_archive if t.pending]),
+            total_fetched    = len(changed),
+            accounts         = len(set( t.account_id for t in changed )),
+        )
+
+        self.print_counts(verbose)
+        balances = result_of(balances)
+
+        if verbose:
+            print("    Archiving %d transactions" % (len(to_archive)))
+            print("    Saving %d balances, %d transactions" % (len(balances or []), len(changed)))
+
+        with metrics.timer("write"):
+            self.db.save_account_sync(
+                item_info               = self.item_info,
+                balances                = balances,
+                transactions            = changed,
+                archive_transaction_ids = delta.removed,
+                cursor                  = delta.next_cursor,
+                synced_update           = self.item_info.ts_last_successful_update,
+            )
+
+    def start_cursor(self, balances, verbose=False):
+        """
+        Establishes the item's first /transactions/sync cursor. Plaid only
+        hands out a cursor at the end of the item's full history, so that
+        history is diffed against the database and saved along with it.
+        """
+        if verbose:
+            print("    No sync cursor stored for this item yet, fetching full transaction history")
+
+        with metrics.timer("fetch_transactions"):
+            delta = self.plaid.get_transactions_delta(self.access_token)
+        _, changed = changes_not_removed(delta)
+
+        account_ids = set( t.account_id for t in changed )
+        self.account_ids.update(account_ids)
+
+        # the whole history is compared, whatever its dates
+        with metrics.timer("diff"):
+            try:
+                tids_new, tids_modified = self.db.stage_transactions( self.sync_key, datetime.date.min, datetime.date.max, changed )
+            finally:
+                self.db.clear_staging(self.sync_key)
+            to_archive = self.db.fetch_transactions_by_id(delta.removed, active_only=True)
+
+        self.add_transactions( changed )
+        self.add_transactions( to_archive )
+
+        self.counts = SyncCounts(
+            new              = len(tids_new),
+            new_pending      = self.count_pending(tids_new),
+            modified         = len(tids_modified),
+            archived         = len(to_archive),
+            archived_pending = len([t for t in to_archive if t.pending]),
+            total_fetched    = len(changed),
+            accounts         = len(account_ids),
+        )
+
+        self.print_counts(verbose)
+        balances = result_of(balances)
+
+        if verbose:
+            print("    Archiving %d transactions" % (len(to_archive)))
+            print("    Saving %d balances, %d transactions" % (len(balances or []), len(tids_new) + len(tids_modified)))
+
+        with metrics.timer("write"):
+            self.db.save_account_sync(
+                item_info               = self.item_info,
+                balances                = balances,
+                transactions            = [self.transactions[tid] for tid in tids_new + tids_modified],
+                archive_transaction_ids = [t.transaction_id for t in to_archive],
+                cursor                  = delta.next_cursor,
+                synced_update           = self.item_info.ts_last_successful_update,
+                account_ids             = account_ids,
+            )
+
+    def print_counts(self, verbose):
+        if verbose:
+            print("    Fetched %d new (%d pending), %d modified, %d to archive (%d were pending), %d total transactions from %d accounts" % (
+                self.counts.new,
+                self.counts.new_pending,
+                self.counts.modified,
+                self.counts.archived,
+                self.counts.archived_pending,
+                self.counts.total_fetched,
+                self.counts.accounts
+            ))
+
+
+
+class AsyncPlaidSynchronizer(PlaidSynchronizer):
+    """
+    PlaidSynchronizer for an AsyncPlaidAPI. Plaid requests run as coroutines
+    on the event loop, while database work, which blocks, runs on the loop's
+    default executor.
+    """
+    async def sync_async(self, start_date, end_date, fetch_balances=True, verbose=False, force=False, settle_days=14):
+        """
+        Same as sync, without incremental, backfill and batch_size, and
+        deciding what to fetch with the same skip_unchanged and plan_window.
+        """
+        import asyncio
+        import plaidapi
+
+        loop = asyncio.get_running_loop()
+
+        def in_executor(fn, *args):
+            # executor threads don't inherit the active metrics
+            return loop.run_in_executor(None, contextvars.copy_context().run, fn, *args)
+
+        with metrics.activate(self.metrics), metrics.timer("total"):
+            balances_task = None
+            try:
+                if verbose:
+                    print("Account: %s" % self.account_name)
 
-            self.db.save_item_info(self.item_info)
+                if fetch_balances:
+                    balances_task = asyncio.create_task(self.fetch_balances_async(verbose))
 
-            if balances:
-                for balance in balances:
-                    self.db.save_balance(self.item_info.item_id, balance)
+                if verbose:
+                    print("    Fetching item (bank login) info")
+                with metrics.timer("item_info"):
+                    self.item_info = await self.plaid.get_item_info(self.access_token)
 
-            for tid in tids_new:
-                self.db.save_transaction(self.transactions[tid])
+                if await in_executor(self.skip_unchanged, force, verbose):
+                    balances = await balances_task if balances_task else None
+                    await in_executor(self.save_skipped, balances)
+                    return
 
-        except plaidapi.PlaidError as ex:
-            self.plaid_error = ex
+                start_date, end_date = await in_executor(self.plan_window, start_date, end_date, settle_days)
+
+                if verbose:
+                    print("    Fetching transactions from %s to %s" % (start_date, end_date))
+                with metrics.timer("fetch_transactions"):
+                    transactions = await self.plaid.get_transactions(
+                        access_token    = self.access_token,
+                        start_date      = start_date,
+                        end_date        = end_date,
+                        status_callback = self.status_callback(verbose)
+                    )
+
+                # awaited here, as the database work in the executor cannot wait for a task
+                balances = await balances_task if balances_task else None
+                await in_executor(self.save_fetched_transactions, start_date, end_date, transactions, balances, verbose)
+
+            except plaidapi.PlaidError as ex:
+                await in_executor(self.record_plaid_error, ex)
+            finally:
+                if balances_task:
+                    # not needed after an error; cancel() does nothing if it
+                    # already finished, and its error (if any) is dropped
+                    balances_task.cancel()
+                    if balances_task.done() and not balances_task.cancelled():
+                        balances_task.exception()
+
+    async def fetch_balances_async(self, verbose=False):
+        if verbose:
+            print("    Fetching current balances")
+        with metrics.timer("balances"):
+            return await self.plaid.get_account_balance(self.access_token)
 
 
 def try_get_tqdm():
@@ -158,7 +753,9 @@ def try_get_tqdm():
         return None
 
 
-def update_account(cfg: config.Config, plaid: plaidapi.PlaidAPI, account_name: str):
+def update_account(cfg: config.Config, plaid: 'plaidapi.PlaidAPI', account_name: str):
+    from plaidapi import PlaidAccountUpdateNeeded, PlaidError
+
     try:
         print("Starting account update process for [%s]" % account_name)
 
@@ -202,6 +799,7 @@ def update_account(cfg: config.Config, plaid: plaidapi.PlaidAPI, account_name: s
             sys.exit(1)
 
         public_token = plaid_response['public_token']
+        plaid.invalidate_cache(cfg.get_account_access_token(account_name))
         print("")
         print(f"Public token obtained [{public_token}].")
         print("")
@@ -215,7 +813,9 @@ def update_account(cfg: config.Config, plaid: plaidapi.PlaidAPI, account_name: s
         print(ex)
 
 
-def link_account(cfg: config.Config, plaid: plaidapi.PlaidAPI, account_name: str):
+def link_account(cfg: config.Config, plaid: 'plaidapi.PlaidAPI', account_name: str):
+    from plaidapi import PlaidError
+
     if account_name in cfg.get_all_config_sections():
         print("Cannot link new account - the account name you selected")
         print("is already defined in your local configuration. Re-run with")
@@ -275,11 +875,201 @@ def link_account(cfg: config.Config, plaid: plaidapi.PlaidAPI, account_name: str
     sys.exit(0)
 
 
+def recompress(db: transactionsdb.TransactionsDB):
+    print("Recompressing stored Plaid JSON")
+    stats = db.recompress()
+    print("Compression:   %s" % (stats['codec'] or "none"))
+    print("Plaid JSON:    %10d bytes -> %10d bytes (%.1f%%)" % (
+        stats['bytes_before'], stats['bytes_after'], 100.0 * stats['bytes_after'] / max(1, stats['bytes_before'])))
+    print("Database file: %10d bytes -> %10d bytes (%.1f%%)" % (
+        stats['page_bytes_before'], stats['page_bytes_after'], 100.0 * stats['page_bytes_after'] / max(1, stats['page_bytes_before'])))
+    print("Decoded %d transactions in %.3fs (%.0f/s, %.1f MB/s)" % (
+        stats['decode_rows'], stats['decode_seconds'],
+        stats['decode_rows'] / max(stats['decode_seconds'], 1e-9),
+        stats['decode_chars'] / max(stats['decode_seconds'], 1e-9) / 1e6))
+
+
+def merge_shards(db: transactionsdb.TransactionsDB, shard_files):
+    for shard_file in shard_files:
+        try:
+            stats = db.merge_shard(shard_file)
+        except ValueError as ex:
+            print("Error: %s" % ex, file=sys.stderr)
+            sys.exit(1)
+        print("Merged %s: %d transactions, %d balances, %d items, %d backfill checkpoints inserted or updated" % (
+            shard_file, stats['transactions'], stats['balances'], stats['items'], stats['backfill_windows']))
+
+
+def age(timestamp, now):
+    """
+    How long before now timestamp was, as e.g. "3d 4h".
+    """
+    if timestamp is None:
+        return "never"
+    seconds = int((now - timestamp).total_seconds())
+    if seconds < 3600:
+        return "%dm" % (seconds // 60)
+    if seconds < 86400:
+        return "%dh %dm" % (seconds // 3600, seconds % 3600 // 60)
+    return "%dd %dh" % (seconds // 86400, seconds % 86400 // 3600)
+
+
+def report_items(db: transactionsdb.TransactionsDB):
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    print("%-40s %-12s %-10s %-10s %-10s %s" % ("Item", "Institution", "Refreshed", "Synced", "Saved", "Status"))
+    for item in db.get_item_status():
+        if item['last_failed_update'] and (not item['last_successful_update'] or item['last_failed_update'] > item['last_successful_update']):
+            status = "Last attempt failed at %s" % item['last_failed_update']
+        elif not item['last_successful_update'] or item['last_successful_update'] < (now - datetime.timedelta(days=3)):
+            status = "Last successful update > 3 days ago"
+        else:
+            status = "OK"
+        if item['consent_expiration']:
+            status += ", consent expires %s" % item['consent_expiration'].date()
+
+        print("%-40s %-12s %-10s %-10s %-10s %s" % (
+            item['item_id'], item['institution_id'],
+            age(item['last_successful_update'], now), age(item['synced_update'], now), age(item['updated'], now),
+            status,
+        ))
+
+
+def report_balances(db: transactionsdb.TransactionsDB):
+    print("%-40s %-10s %-12s %14s %14s %14s %-4s %s" % ("Account", "Type", "Date", "Current", "Available", "Limit", "", "Name"))
+    for balance in db.get_latest_balances():
+        print("%-40s %-10s %-12s %14s %14s %14s %-4s %s" % (
+            balance['account_id'], balance['account_type'], balance['date'],
+            *("%.2f" % balance[b] if balance[b] is not None else "" for b in ("balance_current", "balance_available", "balance_limit")),
+            balance['currency_code'] or "",
+            "%s (%s)" % (balance['name'], balance['mask']) if balance['mask'] else balance['name'],
+        ))
+
+
+def report_transactions(db: transactionsdb.TransactionsDB):
+    names = dict((b['account_id'], b['name']) for b in db.get_latest_balances())
+    print("%-40s %8s %8s %8s %-12s %-12s %s" % ("Account", "Active", "Pending", "Archived", "First", "Last", "Name"))
+    for counts in db.get_transaction_counts():
+        print("%-40s %8d %8d %8d %-12s %-12s %s" % (
+            counts['account_id'], counts['active'], counts['pending'], counts['archived'],
+            counts['first_date'] or "", counts['last_date'] or "", names.get(counts['account_id'], ""),
+        ))
+
+
+REPORTS = {
+    'items':        report_items,
+    'balances':     report_balances,
+    'transactions': report_transactions,
+}
+
+
+def write_metrics(args, results, started, finished):
+    report = metrics.build_report(started, finished, [
+        dict(sync.metrics.as_dict(),
+             counts=sync.counts._asdict(),
+             error=str(sync.plaid_error) if sync.plaid_error else None)
+        for sync in results.values()
+    ])
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json, report)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom, report)
+
+
+def run_daemon(args, cfg: config.Config, run_account):
+    options = cfg.get_daemon_options()
+    if args.status_port is not None:
+        options['status_port'] = args.status_port
+
+    import daemon
+    scheduler = daemon.Scheduler(args.config_file, run_account, jobs=args.jobs, shard=args.shard, **options)
+
+    def stop(signum, frame):
+        scheduler.stop()
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        scheduler.serve_forever()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+async def sync_accounts_async(args, cfg: config.Config, db, plaid, accounts, progress=None):
+    """
+    Synchronizes accounts with an AsyncPlaidSynchronizer each, up to
+    args.jobs at a time, and returns them by account name.
+    """
+    import asyncio
+    semaphore = asyncio.Semaphore(args.jobs)
+
+    async def process_account(account_name):
+        async with semaphore:
+            sync = AsyncPlaidSynchronizer(db, plaid, account_name, cfg.get_account_access_token(account_name))
+            await sync.sync_async(args.start_date, args.end_date or datetime.date.today(), fetch_balances=args.balances,
+                                  verbose=args.verbose, force=args.force, settle_days=cfg.get_settle_days())
+        if progress: progress.update()
+        return sync
+
+    try:
+        syncs = await asyncio.gather(*(process_account(account_name) for account_name in accounts))
+    finally:
+        await plaid.close()
+    return dict(zip(accounts, syncs))
+
+
 def main():
     args = parse_options()
     cfg = config.Config(args.config_file)
-    db = transactionsdb.TransactionsDB(cfg.get_dbfile())
-    plaid = plaidapi.PlaidAPI(**cfg.get_plaid_client_config())
+    dbfile = cfg.get_shard_dbfile(*args.shard) if args.shard else cfg.get_dbfile()
+
+    if args.report:
+        if not os.path.exists(dbfile):
+            print("Database [%s] does not exist, nothing has been synchronized yet." % dbfile, file=sys.stderr)
+            sys.exit(1)
+        try:
+            db = transactionsdb.TransactionsDB(dbfile, read_only=True)
+        except ValueError as ex:
+            print("Error: %s" % ex, file=sys.stderr)
+            sys.exit(1)
+        REPORTS[args.report](db)
+        return
+
+    if args.rebuild_rollups:
+        rows = transactionsdb.TransactionsDB(dbfile, **cfg.get_db_options()).rebuild_rollups()
+        print("Rebuilt daily_rollups: %d rows" % rows)
+        return
+
+    if args.jobs > 1 or (args.backfill and args.backfill_jobs > 1) or args.daemon or args.use_async:
+        # all database access is funnelled through one writer thread
+        db = transactionsdb.TransactionsDBWriter(dbfile, **cfg.get_db_options())
+    else:
+        db = transactionsdb.TransactionsDB(dbfile, **cfg.get_db_options())
+
+    if args.recompress:
+        recompress(db)
+        return
+
+    if args.merge_shards:
+        merge_shards(db, args.merge_shards)
+        return
+
+    import responsecache
+
+    try:
+        plaid_config = cfg.get_plaid_client_config()
+    except ValueError as ex:
+        print("Error: %s" % ex, file=sys.stderr)
+        sys.exit(1)
+    # one pooled connection for every request that can be in flight at once
+    # (transaction pages, plus the balances request running alongside them)
+    concurrent_requests = args.jobs * (plaid_config['page_fanout'] * (args.backfill_jobs if args.backfill else 1) + 1)
+    cache_options = cfg.get_response_cache_options()
+    response_cache = responsecache.ResponseCache(**cache_options) if cache_options and not args.no_cache else None
+    if args.use_async:
+        import asyncplaidapi
+        plaid = asyncplaidapi.AsyncPlaidAPI(**plaid_config, pool_size=concurrent_requests, response_cache=response_cache)
+    else:
+        import plaidapi
+        plaid = plaidapi.PlaidAPI(**plaid_config, pool_size=concurrent_requests, response_cache=response_cache)
 
     if args.update_account:
         update_account(cfg, plaid, args.update_account)
@@ -296,33 +1086,79 @@ def main():
         print("Re-run with --link-account to add one.")
         sys.exit(1)
 
-    results = {}
-
-    def process_account(account_name):
+    def process_account(account_name, cfg=cfg):
         sync = PlaidSynchronizer(db, plaid, account_name, cfg.get_account_access_token(account_name))
-        sync.sync(args.start_date, args.end_date, fetch_balances=args.balances, verbose=args.verbose)
-        results[account_name] = sync
+        sync.sync(args.start_date, args.end_date or datetime.date.today(), fetch_balances=args.balances, verbose=args.verbose,
+                  batch_size=args.batch_size, incremental=args.incremental,
+                  backfill=args.backfill, backfill_jobs=args.backfill_jobs, force=args.force,
+                  settle_days=cfg.get_settle_days())
+        return sync
+
+    if args.daemon:
+        run_daemon(args, cfg, lambda cfg, account_name: process_account(account_name, cfg))
+        db.close()
+        return
 
+    accounts = cfg.get_enabled_accounts(args.shard)
+    started  = time.time()
+    if args.shard and args.verbose:
+        print("Shard %d/%d: %d of %d accounts, into %s" % (
+            args.shard[0], args.shard[1], len(accounts), len(cfg.get_enabled_accounts()), dbfile))
     tqdm = try_get_tqdm() if not args.verbose else None
-    if tqdm:
-        for account_name in tqdm(cfg.get_enabled_accounts(), desc="Synchronizing Plaid accounts", leave=False):
-            process_account(account_name)
+    progress = tqdm(total=len(accounts), desc="Synchronizing Plaid accounts", leave=False) if tqdm else None
+
+    results = {}
+    if args.use_async:
+        import asyncio
+        results = asyncio.run(sync_accounts_async(args, cfg, db, plaid, accounts, progress))
+    elif args.jobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {
+                account_name: pool.submit(process_account, account_name)
+                for account_name in accounts
+            }
+            for future in concurrent.futures.as_completed(futures.values()):
+                if progress: progress.update()
+            # keep the configured account order for reporting
+            for account_name, future in futures.items():
+                results[account_name] = future.result()
     else:
-        for account_name in cfg.get_enabled_accounts():
-            process_account(account_name)
+        for account_name in accounts:
+            results[account_name] = process_account(account_name)
+            if progress: progress.update()
+
+    if isinstance(db, transactionsdb.TransactionsDBWriter):
+        db.close()
+
+    if progress: progress.close()
+
+    if args.verbose and not args.use_async:
+        connections, requests_sent = plaid.connection_stats()
+        print("")
+        print("%d requests sent to Plaid over %d connections" % (requests_sent, connections))
+
+    if args.metrics_json or args.metrics_prom:
+        write_metrics(args, results, started, time.time())
 
     print("")
     print("")
     print("Finished syncing %d Plaid accounts" % (len(results)))
     print("")
     for account_name, sync in results.items():
-        print("%-50s: %2d new transactions (%d pending), %2d archived transactions over %d accounts" % (
+        if sync.skipped:
+            print("%-50s: no new data from Plaid since the last sync" % account_name)
+            continue
+
+        print("%-50s: %2d new transactions (%d pending), %2d modified, %2d archived transactions over %d accounts" % (
             account_name,
             sync.counts.new,
             sync.counts.new_pending,
+            sync.counts.modified,
             sync.counts.archived,
             sync.counts.accounts,
         ))
+        if sync.window:
+            print("%50s: transactions from %s to %s" % ("", sync.window[0], sync.window[1]))
 
         if sync.plaid_error:
             import textwrap
@@ -1,59 +1,40 @@
 #!/python3
 
-import re
 import datetime
+import collections
+import concurrent.futures
+import inspect
+import itertools
+import random
+import threading
+import time
 
 import plaid
+import requests
+import requests.adapters
+from plaid.internal.utils import urljoin
 from typing import Optional, List
 
+import jsoncodec
+import metrics
+from plaidmodels import AccountBalance, AccountInfo, Transaction, TransactionsDelta
+from responsecache import ResponseCache
 
-class AccountBalance:
-    def __init__(self, data):
-        self.raw_data = data
-        self.account_id        = data['account_id']
-        self.account_name      = data['name']
-        self.account_type      = data['type']
-        self.account_subtype   = data['subtype']
-        self.account_number    = data['mask']
-        self.balance_current   = data['balances']['current']
-        self.balance_available = data['balances']['available']
-        self.balance_limit     = data['balances']['limit']
-        self.currency_code     = data['balances']['iso_currency_code']
-
-
-class AccountInfo:
-    def __init__(self, data):
-        self.raw_data = data
-        self.item_id                   = data['item']['item_id']
-        self.institution_id            = data['item']['institution_id']
-        self.ts_consent_expiration     = parse_optional_iso8601_timestamp(data['item']['consent_expiration_time'])
-        self.ts_last_failed_update     = parse_optional_iso8601_timestamp(data['status']['transactions']['last_failed_update'])
-        self.ts_last_successful_update = parse_optional_iso8601_timestamp(data['status']['transactions']['last_successful_update'])
-
-
-class Transaction:
-    def __init__(self, data):
-        self.raw_data = data
-        self.account_id     = data['account_id']
-        self.date           = data['date']
-        self.transaction_id = data['transaction_id']
-        self.pending        = data['pending']
-        self.merchant_name  = data['merchant_name']
-        self.amount         = data['amount']
-        self.currency_code  = data['iso_currency_code']
-
-    def __str__(self):
-        return "%s %s %s - %4.2f %s" % ( self.date, self.transaction_id, self.merchant_name, self.amount, self.currency_code )
+# maximum page size allowed by /transactions/get
+TRANSACTIONS_PAGE_SIZE = 500
 
+# errors worth retrying, by error_type - None retries every code of the type
+# https://plaid.com/docs/errors/
+RETRYABLE_ERRORS = {
+    'RATE_LIMIT_EXCEEDED': None,
+    'API_ERROR':           {'INTERNAL_SERVER_ERROR', 'PLANNED_MAINTENANCE'},
+    'INSTITUTION_ERROR':   {'INSTITUTION_DOWN', 'INSTITUTION_NOT_RESPONDING', 'INSTITUTION_NOT_AVAILABLE'},
+    'ITEM_ERROR':          {'PRODUCT_NOT_READY'},
+}
 
-def parse_optional_iso8601_timestamp(ts: Optional[str]) -> datetime.datetime:
-    if ts is None:
-        return None
-    # sometimes the milliseconds coming back from plaid have less than 3 digits
-    # which fromisoformat hates - it also hates "Z", so strip those off from this
-    # string (the milliseconds hardly matter for this purpose, and I'd rather avoid
-    # having to pull dateutil JUST for this parsing)
-    return datetime.datetime.fromisoformat(re.sub(r"[.][0-9]+Z", "+00:00", ts))
+# requests that must not be re-sent if the connection fails after sending,
+# as the first attempt may have gone through
+NOT_RETRYABLE_ON_CONNECTION_ERROR = {'/item/public_token/exchange'}
 
 
 def raise_plaid(ex: plaid.errors.ItemError):
@@ -66,6 +47,37 @@ def raise_plaid(ex: plaid.errors.ItemError):
 
 
 def wrap_plaid_error(f):
+    if inspect.iscoroutinefunction(f):
+        async def wrap_coroutine(*args, **kwargs):
+            try:
+                return await f(*args, **kwargs)
+            except plaid.errors.PlaidError as ex:
+                raise_plaid(ex)
+        return wrap_coroutine
+
+    if inspect.isasyncgenfunction(f):
+        async def wrap_async_generator(*args, **kwargs):
+            generator = f(*args, **kwargs)
+            try:
+                async for item in generator:
+                    yield item
+            except plaid.errors.PlaidError as ex:
+                raise_plaid(ex)
+            finally:
+                # closing this wrapper early has to close f's generator too
+                await generator.aclose()
+        return wrap_async_generator
+
+    if inspect.isgeneratorfunction(f):
+        # errors from a generator are raised while it is being iterated,
+        # not when it is called
+        def wrap_generator(*args, **kwargs):
+            try:
+                yield from f(*args, **kwargs)
+            except plaid.errors.PlaidError as ex:
+                raise_plaid(ex)
+        return wrap_generator
+
     def wrap(*args, **kwargs):
         try:
             return f(*args, **kwargs)
@@ -96,14 +108,282 @@ class PlaidAccountUpdateNeeded(PlaidError):
     pass
 
 
+def is_retryable(ex: plaid.errors.PlaidError) -> bool:
+    if ex.type not in RETRYABLE_ERRORS:
+        return False
+    codes = RETRYABLE_ERRORS[ex.type]
+    return codes is None or ex.code in codes
+
+
+class TokenBucket:
+    """
+    Limits the rate of API requests across every thread sharing the bucket.
+
+    The rate adapts to the API (additive increase, multiplicative decrease):
+    every rate limit error halves it, and every successful request earns a
+    little of it back, up to the configured maximum. With many accounts
+    synchronizing at once this keeps the request rate just under whatever
+    the API is currently accepting, rather than every worker hammering it
+    and backing off on its own.
+    """
+    def __init__(self, rate: float, burst: Optional[float]=None, min_rate: float=0.5):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate     = rate
+        self.burst    = burst or rate
+        self.tokens   = self.burst
+        self.updated  = time.monotonic()
+        self.decreased = 0.0
+        self.lock     = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token and returns 0 if a request may be sent now, otherwise
+        returns how long to wait before trying again.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def rate_limited(self):
+        with self.lock:
+            now = time.monotonic()
+            # requests already in flight get rate limited together, which
+            # should only count as a single decrease
+            if now - self.decreased < 1:
+                return
+            self.decreased = now
+            self.rate      = max(self.min_rate, self.rate / 2)
+            # drop whatever burst was saved up at the old rate
+            self.tokens    = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class RetryPolicy:
+    """
+    How often, and after how long, retryable errors (see RETRYABLE_ERRORS)
+    and connection failures are retried. Delays grow exponentially from
+    base_delay up to max_delay, with full jitter so that workers which
+    failed together do not retry together.
+    """
+    def __init__(self, max_retries: int=5, base_delay: float=0.5, max_delay: float=30.0):
+        self.max_retries = max_retries
+        self.base_delay  = base_delay
+        self.max_delay   = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class PlaidClient(plaid.Client):
+    """
+    plaid.Client that can send its requests to a different host than
+    https://<environment>.plaid.com, such as a local fake Plaid server
+    (see fakeplaid.py) for testing without bank credentials.
+
+    Every request waits for the shared rate_limiter (if any), and transient
+    errors are retried according to retry_policy.
+
+    Requests are sent through session, so connections are kept alive and
+    reused rather than paying for a new TLS handshake every time. timeout
+    (inherited from plaid.Client) is the read timeout.
+    """
+    def __init__(self, *args, base_url: Optional[str]=None, retry_policy: Optional[RetryPolicy]=None,
+                 rate_limiter: Optional[TokenBucket]=None, session: Optional[requests.Session]=None,
+                 connect_timeout: Optional[float]=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url        = base_url or ('https://' + self.environment + '.plaid.com')
+        self.retry_policy    = retry_policy or RetryPolicy(max_retries=0)
+        self.rate_limiter    = rate_limiter
+        self.session         = session or requests.Session()
+        self.connect_timeout = connect_timeout
+
+    def _post(self, path, data, is_json):
+        attempt = 0
+        while True:
+            try:
+                return self._post_once(path, data, is_json)
+            except plaid.errors.PlaidError as ex:
+                if ex.type == 'RATE_LIMIT_EXCEEDED':
+                    metrics.count("rate_limited")
+                    if self.rate_limiter:
+                        self.rate_limiter.rate_limited()
+                if not is_retryable(ex) or attempt >= self.retry_policy.max_retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if path in NOT_RETRYABLE_ON_CONNECTION_ERROR or attempt >= self.retry_policy.max_retries:
+                    raise
+
+            metrics.count("retries")
+            time.sleep(self.retry_policy.delay(attempt))
+            attempt += 1
+
+    def _post_once(self, path, data, is_json):
+        headers = {'User-Agent': 'Plaid Python v{}'.format(plaid.version.__version__)}
+        if self.api_version is not None:
+            headers['Plaid-Version'] = self.api_version
+        if self.client_app is not None:
+            headers['Plaid-Client-App'] = self.client_app
+
+        if self.rate_limiter:
+            with metrics.timer("rate_limit_wait"):
+                self.rate_limiter.acquire()
+
+        response = self.session.post(
+            urljoin(self.base_url, path),
+            json=data,
+            headers=headers,
+            timeout=(self.connect_timeout, self.timeout),
+        )
+
+        metrics.count("api_calls")
+        metrics.count("api_bytes", len(response.content))
+
+        result = parse_plaid_response(response.content, response.headers.get('Content-Type'), is_json)
+        if self.rate_limiter:
+            self.rate_limiter.succeeded()
+        return result
+
+
+def parse_plaid_response(content: bytes, content_type: Optional[str], is_json: bool):
+    """
+    Same handling of API responses as the Plaid SDK's requester: errors in
+    the response body are raised as plaid.errors.PlaidError.
+    """
+    if is_json or content_type == 'application/json':
+        try:
+            response_body = jsoncodec.loads(content)
+        except ValueError:
+            raise plaid.errors.PlaidError.from_response({
+                'error_message': content.decode("utf-8", "replace"),
+                'error_type': 'API_ERROR',
+                'error_code': 'INTERNAL_SERVER_ERROR',
+                'display_message': None,
+                'request_id': '',
+                'causes': [],
+            })
+        if response_body.get('error_type'):
+            raise plaid.errors.PlaidError.from_response(response_body)
+        return response_body
+    return content
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """
+    A keep-alive session that holds on to up to pool_size idle connections
+    per host. Requests beyond that still work, but their connections are
+    closed afterwards instead of being reused.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetched_date(fetched: float) -> datetime.date:
+    """
+    The UTC day of a time.time() timestamp, which balances are stored under.
+    """
+    return datetime.datetime.fromtimestamp(fetched, datetime.timezone.utc).date()
+
+
 class PlaidAPI():
-    def __init__(self, client_id: str, secret: str, environment: str, suppress_warnings=True):
-        self.client = plaid.Client(
+    def __init__(self, client_id: str, secret: str, environment: str, suppress_warnings=True, page_fanout: int=4, base_url: Optional[str]=None,
+                 max_retries: int=5, requests_per_second: Optional[float]=50, pool_size: Optional[int]=None,
+                 connect_timeout: float=10, read_timeout: float=600, response_cache: Optional[ResponseCache]=None):
+        """
+        max_retries is how often transient errors (rate limiting, institution
+        or Plaid outages) are retried before giving up on a request.
+
+        requests_per_second caps the request rate of this PlaidAPI, shared by
+        every account and thread using it; it is lowered automatically when
+        Plaid reports rate limiting. None disables the limit.
+
+        pool_size is the number of connections kept open for reuse, which
+        should match the number of requests made concurrently (by default,
+        page_fanout).
+
+        If response_cache is given, balances are served from it
+        while fresh (see ResponseCache), instead of being requested again.
+        """
+        self.session = make_session(pool_size or page_fanout)
+        self.client = PlaidClient(
             client_id,
             secret,
             environment,
-            suppress_warnings
+            suppress_warnings,
+            timeout=read_timeout,
+            base_url=base_url,
+            retry_policy=RetryPolicy(max_retries=max_retries),
+            rate_limiter=TokenBucket(requests_per_second) if requests_per_second else None,
+            session=self.session,
+            connect_timeout=connect_timeout,
         )
+        self.page_fanout = page_fanout
+        self.response_cache = response_cache
+
+    def cached_response(self, endpoint: str, access_token: str, fetch):
+        """
+        Returns the response and the time it was fetched from Plaid, from the
+        response cache if it holds a fresh one, or else from fetch(), which
+        then replaces the cached one.
+        """
+        if self.response_cache:
+            cached = self.response_cache.get(endpoint, access_token)
+            if cached is not None:
+                metrics.count("cache_hits")
+                return cached
+            metrics.count("cache_misses")
+
+        response = fetch()
+        if self.response_cache:
+            self.response_cache.put(endpoint, access_token, response)
+        return response, time.time()
+
+    def invalidate_cache(self, access_token: Optional[str]=None):
+        """
+        Drops cached responses for access_token, or for every item.
+        """
+        if self.response_cache:
+            self.response_cache.invalidate(access_token)
+
+    def connection_stats(self) -> (int, int):
+        """
+        Returns how many connections have been opened, and how many requests
+        were sent over them, for the hosts currently in the session's pool.
+        """
+        connections = requests_sent = 0
+        adapters = {id(adapter): adapter for adapter in self.session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    connections   += pool.num_connections
+                    requests_sent += pool.num_requests
+        return connections, requests_sent
 
     @wrap_plaid_error
     def get_link_token(self, access_token=None) -> str:
@@ -170,30 +450,113 @@ class PlaidAPI():
         """
         Returns the balances of all accounts associated with this particular access_token.
         """
-        resp = self.client.Accounts.balance.get(access_token=access_token)
-        return list( map( AccountBalance, resp['accounts'] ) )
+        resp, fetched = self.cached_response('balances', access_token, lambda: self.client.Accounts.balance.get(access_token=access_token))
+        return [ AccountBalance(account, fetched_date(fetched)) for account in resp['accounts'] ]
 
     @wrap_plaid_error
-    def get_transactions(self, access_token:str, start_date:datetime.date, end_date:datetime.date, account_ids:Optional[List[str]]=None, status_callback=None):
-        ret = []
-        total_transactions = None
-        while True:
-            response = self.client.Transactions.get(
+    def iter_transaction_pages(self, access_token:str, start_date:datetime.date, end_date:datetime.date, account_ids:Optional[List[str]]=None, status_callback=None, page_fanout:Optional[int]=None):
+        """
+        Yields the transactions between start_date and end_date one page at a
+        time, in offset order.
+
+        The first page tells us total_transactions, so the offsets of all
+        remaining pages are known up front and they are fetched concurrently.
+        At most page_fanout pages are requested ahead of the consumer, which
+        keeps memory bounded no matter how large the date range is.
+
+        Pages are not deduplicated; a transaction may show up twice if the
+        data shifts between pages while they are being fetched.
+        """
+        page_fanout = page_fanout or self.page_fanout
+
+        def fetch_page(offset):
+            return self.client.Transactions.get(
                             access_token,
                             start_date.strftime("%Y-%m-%d"),
                             end_date.strftime("%Y-%m-%d"),
                             account_ids=account_ids,
-                            offset=len(ret),
-                            count=500)
-
-            total_transactions = response['total_transactions']
+                            offset=offset,
+                            count=TRANSACTIONS_PAGE_SIZE)
+
+        response = fetch_page(0)
+        metrics.count("pages")
+        total_transactions = response['total_transactions']
+        fetched = len(response['transactions'])
+        if status_callback: status_callback(fetched, total_transactions)
+        yield [Transaction(t) for t in response['transactions']]
+
+        if not fetched:
+            return
+
+        offsets = iter(range(fetched, total_transactions, TRANSACTIONS_PAGE_SIZE))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=page_fanout) as pool:
+            pending = collections.deque(
+                metrics.submit(pool, fetch_page, offset)
+                for offset in itertools.islice(offsets, page_fanout)
+            )
+            while pending:
+                response = pending.popleft().result()
+                for offset in itertools.islice(offsets, 1):
+                    pending.append(metrics.submit(pool, fetch_page, offset))
+
+                metrics.count("pages")
+                fetched += len(response['transactions'])
+                if status_callback: status_callback(fetched, total_transactions)
+                yield [Transaction(t) for t in response['transactions']]
+
+    def get_transactions(self, access_token:str, start_date:datetime.date, end_date:datetime.date, account_ids:Optional[List[str]]=None, status_callback=None, page_fanout:Optional[int]=None):
+        """
+        Returns all transactions between start_date and end_date, deduplicated
+        by transaction_id. See iter_transaction_pages.
+        """
+        ret = {}
+        for page in self.iter_transaction_pages(access_token, start_date, end_date, account_ids, status_callback, page_fanout):
+            for t in page:
+                ret.setdefault(t.transaction_id, t)
+        return list(ret.values())
 
-            ret += [
-                Transaction(t)
-                for t in response['transactions']
-            ]
+    @wrap_plaid_error
+    def get_transactions_delta(self, access_token:str, cursor:Optional[str]=None) -> TransactionsDelta:
+        """
+        Returns everything added, modified and removed since cursor, using
+        /transactions/sync. Without a cursor, the item's full transaction
+        history is returned as added.
 
-            if status_callback: status_callback(len(ret), total_transactions)
-            if len(ret) >= total_transactions: break
+        Pages are followed until has_more is false. If the data changes while
+        paging, Plaid asks for the whole update to be restarted from the
+        original cursor, which is done here, up to the client's
+        RetryPolicy.max_retries times and after its backoff delay.
 
-        return ret
+        https://plaid.com/docs/api/products/transactions/#transactionssync
+        """
+        restarts = 0
+        while True:
+            added, modified, removed = [], [], []
+            next_cursor = cursor
+            try:
+                while True:
+                    data = {
+                        'access_token': access_token,
+                        'count': TRANSACTIONS_PAGE_SIZE,
+                    }
+                    if next_cursor:
+                        data['cursor'] = next_cursor
+
+                    response = self.client.post('/transactions/sync', data)
+                    metrics.count("pages")
+
+                    added    += [ Transaction(t) for t in response['added'] ]
+                    modified += [ Transaction(t) for t in response['modified'] ]
+                    removed  += [ t['transaction_id'] for t in response['removed'] ]
+                    next_cursor = response['next_cursor']
+
+                    if not response['has_more']:
+                        return TransactionsDelta(added, modified, removed, next_cursor)
+            except plaid.errors.PlaidError as ex:
+                retry_policy = self.client.retry_policy
+                if ex.code != 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION' or restarts >= retry_policy.max_retries:
+                    raise
+
+            metrics.count("retries")
+            time.sleep(retry_policy.delay(restarts))
+            restarts += 1
@@ -0,0 +1,159 @@
+"""
+Plaid API response models, kept apart from plaidapi so that code which only
+reads the database (TransactionsDB, the report commands) does not have to
+import the Plaid SDK.
+
+The model classes are views over the raw Plaid payload: fields are read from
+raw_data when accessed rather than copied, and __slots__ keeps each instance
+down to a reference or two, as a large sync holds tens of thousands of them.
+"""
+
+import datetime
+import re
+from typing import List, Optional
+
+
+class AccountBalance:
+    __slots__ = ('raw_data', 'date')
+
+    def __init__(self, data, date: Optional[datetime.date]=None):
+        """
+        date is the (UTC) day the balance was fetched from Plaid, if known.
+        """
+        self.raw_data = data
+        self.date     = date
+
+    @property
+    def account_id(self) -> str:
+        return self.raw_data['account_id']
+
+    @property
+    def account_name(self) -> str:
+        return self.raw_data['name']
+
+    @property
+    def account_type(self) -> str:
+        return self.raw_data['type']
+
+    @property
+    def account_subtype(self) -> str:
+        return self.raw_data['subtype']
+
+    @property
+    def account_number(self) -> str:
+        return self.raw_data['mask']
+
+    @property
+    def balance_current(self) -> Optional[float]:
+        return self.raw_data['balances']['current']
+
+    @property
+    def balance_available(self) -> Optional[float]:
+        return self.raw_data['balances']['available']
+
+    @property
+    def balance_limit(self) -> Optional[float]:
+        return self.raw_data['balances']['limit']
+
+    @property
+    def currency_code(self) -> Optional[str]:
+        return self.raw_data['balances']['iso_currency_code']
+
+
+class AccountInfo:
+    __slots__ = ('raw_data',)
+
+    def __init__(self, data):
+        self.raw_data = data
+
+    @property
+    def item_id(self) -> str:
+        return self.raw_data['item']['item_id']
+
+    @property
+    def institution_id(self) -> str:
+        return self.raw_data['item']['institution_id']
+
+    @property
+    def ts_consent_expiration(self) -> Optional[datetime.datetime]:
+        return parse_optional_iso8601_timestamp(self.raw_data['item']['consent_expiration_time'])
+
+    @property
+    def ts_last_failed_update(self) -> Optional[datetime.datetime]:
+        return parse_optional_iso8601_timestamp(self.raw_data['status']['transactions']['last_failed_update'])
+
+    @property
+    def ts_last_successful_update(self) -> Optional[datetime.datetime]:
+        return parse_optional_iso8601_timestamp(self.raw_data['status']['transactions']['last_successful_update'])
+
+
+class Transaction:
+    __slots__ = ('raw_data',)
+
+    def __init__(self, data):
+        self.raw_data = data
+
+    @property
+    def account_id(self) -> str:
+        return self.raw_data['account_id']
+
+    @property
+    def date(self) -> str:
+        return self.raw_data['date']
+
+    @property
+    def transaction_id(self) -> str:
+        return self.raw_data['transaction_id']
+
+    @property
+    def pending(self) -> bool:
+        return self.raw_data['pending']
+
+    @property
+    def pending_transaction_id(self) -> Optional[str]:
+        return self.raw_data.get('pending_transaction_id')
+
+    @property
+    def merchant_name(self) -> Optional[str]:
+        return self.raw_data['merchant_name']
+
+    @property
+    def category(self) -> Optional[str]:
+        """
+        The category hierarchy, most general first, as e.g.
+        "Shops > Supermarkets and Groceries".
+        """
+        category = self.raw_data.get('category')
+        return " > ".join(category) if category else None
+
+    @property
+    def amount(self) -> float:
+        return self.raw_data['amount']
+
+    @property
+    def currency_code(self) -> Optional[str]:
+        return self.raw_data['iso_currency_code']
+
+    def __str__(self):
+        return "%s %s %s - %4.2f %s" % ( self.date, self.transaction_id, self.merchant_name, self.amount, self.currency_code )
+
+
+class TransactionsDelta:
+    """
+    Changes to an item's transactions since a /transactions/sync cursor.
+    """
+    def __init__(self, added: List[Transaction], modified: List[Transaction], removed: List[str], next_cursor: str):
+        self.added       = added
+        self.modified    = modified
+        self.removed     = removed
+        self.next_cursor = next_cursor
+
+
+def parse_optional_iso8601_timestamp(ts: Optional[str]) -> datetime.datetime:
+    if ts is None:
+        return None
+    # sometimes the milliseconds coming back from plaid have less than 3 digits
+    # which fromisoformat hates - it also hates "Z", so strip those off from this
+    # string (the milliseconds hardly matter for this purpose, and I'd rather avoid
+    # having to pull dateutil JUST for this parsing)
+    return datetime.datetime.fromisoformat(re.sub(r"[.][0-9]+Z", "+00:00", ts))
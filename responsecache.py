@@ -0,0 +1,104 @@
+"""
+On-disk cache of Plaid API responses, for endpoints whose data does not need
+to be fetched on every run (balances).
+
+Responses are stored in a small SQLite database of their own, keyed by
+endpoint and a hash of the access token, so access tokens are never written
+to the cache. Each endpoint has its own time to live, and the least recently
+used entries are evicted once the cache holds more than max_entries.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import jsoncodec
+
+
+def token_hash(access_token: str) -> str:
+    return hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttls: Dict[str, float], max_entries: int = 1000):
+        """
+        ttls maps endpoint names to the number of seconds a response stays
+        fresh. Endpoints without a TTL are never served from the cache.
+        """
+        self.ttls        = ttls
+        self.max_entries = max_entries
+        # shared by every sync thread, so serialize access
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute("""
+                create table if not exists responses(
+                    endpoint text not null,
+                    token_hash text not null,
+                    stored real not null,
+                    accessed real not null,
+                    response text not null,
+                    primary key(endpoint, token_hash)
+                )
+            """)
+            self.conn.execute("create index if not exists responses_accessed_idx on responses(accessed)")
+
+    def get(self, endpoint: str, access_token: str) -> Optional[Tuple[Dict, float]]:
+        """
+        Returns the cached response and the time (as from time.time()) it was
+        stored, or None if there is none younger than the endpoint's TTL.
+        """
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return None
+
+        key = [endpoint, token_hash(access_token)]
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "select response, stored from responses where endpoint = ? and token_hash = ? and stored > ?", key + [now - ttl]
+            ).fetchone()
+            if not row:
+                return None
+            self.conn.execute("update responses set accessed = ? where endpoint = ? and token_hash = ?", [now] + key)
+        return jsoncodec.loads(row[0]), row[1]
+
+    def put(self, endpoint: str, access_token: str, response: Dict):
+        if not self.ttls.get(endpoint):
+            return
+
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                insert into responses(endpoint, token_hash, stored, accessed, response) values(?,?,?,?,?)
+                    on conflict(endpoint, token_hash) do update
+                        set stored = excluded.stored,
+                            accessed = excluded.accessed,
+                            response = excluded.response
+            """, [endpoint, token_hash(access_token), now, now, jsoncodec.dumps(response)])
+            self.conn.execute("""
+                delete from responses where rowid in (
+                    select rowid from responses order by accessed desc limit -1 offset ?
+                )
+            """, [self.max_entries])
+
+    def invalidate(self, access_token: Optional[str] = None, endpoint: Optional[str] = None):
+        """
+        Drops cached responses for access_token (every endpoint, unless
+        endpoint is given), or the whole cache if neither is given.
+        """
+        with self.lock, self.conn:
+            if access_token and endpoint:
+                self.conn.execute("delete from responses where endpoint = ? and token_hash = ?", [endpoint, token_hash(access_token)])
+            elif access_token:
+                self.conn.execute("delete from responses where token_hash = ?", [token_hash(access_token)])
+            elif endpoint:
+                self.conn.execute("delete from responses where endpoint = ?", [endpoint])
+            else:
+                self.conn.execute("delete from responses")
+
+    def close(self):
+        self.conn.close()
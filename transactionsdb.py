@@ -1,21 +1,129 @@
 #!python3
 
 import sqlite3
-import json
+import contextlib
 import datetime
+import hashlib
+import itertools
+import os
+import queue
+import threading
+import time
+import urllib.parse
+import concurrent.futures
+import contextvars
 
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Iterable, Set, Tuple
 
-from plaidapi import AccountBalance, AccountInfo, Transaction as PlaidTransaction
+import compression
+import jsoncodec
+import metrics
+from plaidmodels import AccountBalance, AccountInfo, Transaction as PlaidTransaction
+
+def content_hash(data: Dict) -> str:
+    """
+    Hash of a Plaid JSON payload, independent of key order, used to tell
+    whether a stored transaction has changed on Plaid's side.
+    """
+    return hashlib.sha1(jsoncodec.canonical_dumps(data)).hexdigest()
 
 def build_placeholders(list):
     return ",".join(["?"]*len(list))
 
+# upper bound for the number of IDs bound to a single "in (?,?,...)" list,
+# well below SQLite's bound variable limit
+MAX_IDS_PER_STATEMENT = 500
+
+def chunked(ids: Iterable[str], size: int = MAX_IDS_PER_STATEMENT) -> Iterable[List[str]]:
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i+size]
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# transaction fields (named as in the Plaid JSON) stored as their own columns
+TRANSACTION_COLUMNS = ("date", "amount", "pending", "merchant_name", "pending_transaction_id")
+
+# daily_rollups keeps the daily total and count of active transactions along
+# each of these dimensions, keyed by the expression's value ('' for null)
+ROLLUP_DIMENSIONS = (
+    ("account",  "account_id"),
+    ("category", "category"),
+    ("merchant", "merchant_name"),
+)
+
+
+def rollup_upsert(row: str, sign: str) -> str:
+    """
+    SQL for a trigger adding (sign '+') or removing (sign '-') the
+    transaction row ('new' or 'old') to or from daily_rollups.
+    """
+    return """
+        insert into daily_rollups(dimension, key, date, amount, transactions)
+            values {VALUES}
+            on conflict(dimension, key, date) DO UPDATE
+                set amount = round(amount + excluded.amount, 4),
+                    transactions = transactions + excluded.transactions;
+    """.replace("{VALUES}", ", ".join(
+        "('%s', coalesce(%s.%s, ''), %s.date, %s%s.amount, %s1)" % (dimension, row, column, row, sign, row, sign)
+        for dimension, column in ROLLUP_DIMENSIONS
+    ))
+
+
+def rollup_delete_empty(row: str) -> str:
+    # one statement per dimension, so each is a primary key lookup
+    return "".join(
+        """
+        delete from daily_rollups
+        where dimension = '%s' and key = coalesce(%s.%s, '') and date = %s.date and transactions = 0;
+        """ % (dimension, row, column, row)
+        for dimension, column in ROLLUP_DIMENSIONS
+    )
+
+
 class TransactionsDB():
-    def __init__(self, dbfile:str):
-        self.conn = sqlite3.connect(dbfile) 
+    def __init__(self, dbfile:str, synchronous:str="NORMAL", cache_size:int=-16000, compression:Optional[str]=None,
+                 read_only:bool=False):
+        """
+        Opens (creating if needed) the database at dbfile.
+
+        The database is switched to WAL journaling, so with synchronous=NORMAL
+        a commit does not need to fsync the main database file. cache_size
+        follows the SQLite pragma: positive values are pages, negative values
+        are KiB.
+
+        If compression is set ('zlib' or 'zstd'), plaid_json values are
+        written compressed; see the compression module. Stored values are
+        decompressed on read whatever the setting, and SQL queries on this
+        connection can use plaid_decode(plaid_json) to get the JSON text.
+
+        If read_only is set, an existing database is opened for queries only:
+        nothing is created, migrated or switched to WAL, and ValueError is
+        raised if its schema is older than the current one.
+        """
+        if read_only:
+            self.conn = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(dbfile)), uri=True)
+            version = self.conn.execute("pragma user_version").fetchone()[0]
+            if version < len(self.migrations()):
+                self.conn.close()
+                raise ValueError("Database [%s] is at schema version %d, expected %d; run a sync to upgrade it" % (
+                    dbfile, version, len(self.migrations())))
+            self.load_compressor(None)
+            return
+
+        # uri=True lets merge_shard attach shards read-only; plain paths are
+        # opened as before
+        self.conn = sqlite3.connect(dbfile, uri=True)
+
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError("Invalid synchronous mode [%s], must be one of %s" % (synchronous, ", ".join(SYNCHRONOUS_MODES)))
 
         c = self.conn.cursor()
+        c.execute("pragma journal_mode=WAL")
+        c.execute("pragma synchronous=%s" % synchronous.upper())
+        c.execute("pragma cache_size=%d" % int(cache_size))
+        c.execute("pragma temp_store=MEMORY")
+
         c.execute("""
             create table if not exists transactions
                 (account_id, transaction_id, created, updated, archived, plaid_json)
@@ -35,6 +143,14 @@ class TransactionsDB():
         """)
         c.execute("create unique index if not exists items_idx ON items(item_id)")
 
+        # fetched transactions are staged here during a sync, so the diff
+        # against stored transactions can be computed with joins in SQLite
+        c.execute("""
+            create temp table if not exists sync_staging
+                (sync_key, transaction_id, account_id, plaid_hash, classified,
+                 primary key(sync_key, transaction_id)) without rowid
+        """)
+
         self.conn.commit()
 
         # This might be needed if there's not consistent support for json_extract in sqlite3 installations
@@ -44,46 +160,460 @@ class TransactionsDB():
         #    return ret
         #self.conn.create_function("json_extract", 2, json_extract)
 
+        self.migrate()
+        self.load_compressor(compression)
+
+    def load_compressor(self, codec: Optional[str]):
+        dictionaries = dict(
+            (dict_id, (dict_codec, dictionary))
+            for dict_id, dict_codec, dictionary in self.conn.execute("select dict_id, codec, dictionary from json_dictionaries")
+        )
+        self.compressor = compression.JSONCompressor(codec, dictionaries)
+        self.conn.create_function("plaid_decode", 1, self.compressor.decompress, deterministic=True)
+        self.conn.create_function("plaid_encode", 1, self.compressor.compress)
+
+    def encode_json(self, data: Dict):
+        return self.compressor.compress(jsoncodec.dumps(data))
+
+    def decode_json(self, value) -> Dict:
+        return jsoncodec.loads(self.compressor.decompress(value))
+
+    def migrations(self) -> List:
+        """
+        The schema migrations, in order; a database at the current schema has
+        a user_version of len(migrations()).
+        """
+        return [
+            self._migrate_transaction_columns,
+            self._migrate_item_cursor,
+            self._migrate_backfill_windows,
+            self._migrate_transaction_hash,
+            self._migrate_item_synced_update,
+            self._migrate_transaction_item_id,
+            self._migrate_json_dictionaries,
+            self._migrate_daily_rollups,
+        ]
+
+    def migrate(self):
+        """
+        Brings an existing database up to the current schema. Each migration
+        runs once, in its own transaction, and is tracked with the SQLite
+        user_version pragma.
+        """
+        version = self.conn.execute("pragma user_version").fetchone()[0]
+        for version, migration in enumerate(self.migrations()[version:], start=version+1):
+            with self.conn:
+                migration(self.conn.cursor())
+                self.conn.execute("pragma user_version=%d" % version)
+
+    def _migrate_transaction_columns(self, c: sqlite3.Cursor):
+        """
+        Stores the commonly queried transaction fields as real columns, so
+        date range lookups can use an index instead of parsing plaid_json
+        for every row. Existing rows are backfilled from their plaid_json.
+        """
+        existing = set( r[1] for r in c.execute("pragma table_info(transactions)") )
+        for column in TRANSACTION_COLUMNS:
+            if column not in existing:
+                c.execute("alter table transactions add column %s" % column)
+
+        c.execute("update transactions set " + ", ".join(
+            "%s = json_extract(plaid_json, '$.%s')" % (column, column)
+            for column in TRANSACTION_COLUMNS
+        ))
+
+        c.execute("create index if not exists transactions_account_date_idx ON transactions(account_id, date) where archived is null")
+        c.execute("create index if not exists transactions_date_idx ON transactions(date) where archived is null")
+        c.execute("create index if not exists transactions_pending_idx ON transactions(pending_transaction_id) where pending_transaction_id is not null")
+
+    def _migrate_item_cursor(self, c: sqlite3.Cursor):
+        """
+        Adds the /transactions/sync cursor for incremental syncs to items.
+        """
+        existing = set( r[1] for r in c.execute("pragma table_info(items)") )
+        if "cursor" not in existing:
+            c.execute("alter table items add column cursor")
+
+    def _migrate_backfill_windows(self, c: sqlite3.Cursor):
+        """
+        Checkpoints for --backfill: one row per item and date window that has
+        been synchronized completely.
+        """
+        c.execute("""
+            create table if not exists backfill_windows
+                (item_id, start_date, end_date, completed)
+        """)
+        c.execute("create unique index if not exists backfill_windows_idx ON backfill_windows(item_id, start_date, end_date)")
+
+    def _migrate_transaction_hash(self, c: sqlite3.Cursor):
+        """
+        Adds the content_hash of each transaction's plaid_json, so sync can
+        tell modified transactions from unchanged ones without loading them.
+        """
+        existing = set( r[1] for r in c.execute("pragma table_info(transactions)") )
+        if "plaid_hash" not in existing:
+            c.execute("alter table transactions add column plaid_hash")
+
+        self.conn.create_function("content_hash", 1, lambda plaid_json: content_hash(jsoncodec.loads(plaid_json)))
+        c.execute("update transactions set plaid_hash = content_hash(plaid_json)")
+
+    def _migrate_item_synced_update(self, c: sqlite3.Cursor):
+        """
+        Adds the item's last_successful_update as of its last complete
+        transactions sync, to tell whether Plaid has refreshed it since.
+        """
+        existing = set( r[1] for r in c.execute("pragma table_info(items)") )
+        if "synced_update" not in existing:
+            c.execute("alter table items add column synced_update")
+
+    def _migrate_transaction_item_id(self, c: sqlite3.Cursor):
+        """
+        Adds the item (bank login) each transaction belongs to, so per-item
+        sync windows can be worked out. Existing rows are backfilled from the
+        accounts in balances, where known.
+        """
+        existing = set( r[1] for r in c.execute("pragma table_info(transactions)") )
+        if "item_id" not in existing:
+            c.execute("alter table transactions add column item_id")
+
+        c.execute("""
+            update transactions set item_id = (
+                select b.item_id from balances b where b.account_id = transactions.account_id limit 1
+            )
+            where item_id is null
+        """)
+        c.execute("create index if not exists transactions_item_date_idx ON transactions(item_id, date) where archived is null")
+
+    def _migrate_json_dictionaries(self, c: sqlite3.Cursor):
+        """
+        Shared dictionaries compressed plaid_json values refer to by dict_id.
+        """
+        c.execute("""
+            create table if not exists json_dictionaries
+                (dict_id integer primary key, codec, dictionary blob, created)
+        """)
+
+    def _migrate_daily_rollups(self, c: sqlite3.Cursor):
+        """
+        Adds each transaction's category, and daily_rollups: the daily total
+        and count of active transactions per account, per category and per
+        merchant, for spend over time queries that would otherwise parse the
+        plaid_json of every row. Triggers on transactions keep it up to date
+        in the same database transaction as every insert, modification and
+        archive. Existing rows are backfilled from their plaid_json.
+        """
+        existing = set( r[1] for r in c.execute("pragma table_info(transactions)") )
+        if "category" not in existing:
+            c.execute("alter table transactions add column category")
+
+        # plaid_json may be compressed by now
+        self.load_compressor(None)
+        self.conn.create_function("plaid_category", 1, lambda plaid_json: PlaidTransaction(self.decode_json(plaid_json)).category)
+        c.execute("update transactions set category = plaid_category(plaid_json)")
+
+        c.execute("""
+            create table if not exists daily_rollups
+                (dimension, key, date, amount, transactions,
+                 primary key(dimension, key, date)) without rowid
+        """)
+
+        columns = "account_id, archived, date, amount, category, merchant_name"
+        c.execute("""
+            create trigger if not exists transactions_rollup_insert after insert on transactions
+            when new.archived is null
+            begin {ADD} end
+        """.replace("{ADD}", rollup_upsert("new", "+")))
+        c.execute("""
+            create trigger if not exists transactions_rollup_update_old after update of {COLUMNS} on transactions
+            when old.archived is null
+            begin {REMOVE} {DELETE_EMPTY} end
+        """.replace("{COLUMNS}", columns).replace("{REMOVE}", rollup_upsert("old", "-")).replace("{DELETE_EMPTY}", rollup_delete_empty("old")))
+        c.execute("""
+            create trigger if not exists transactions_rollup_update_new after update of {COLUMNS} on transactions
+            when new.archived is null
+            begin {ADD} end
+        """.replace("{COLUMNS}", columns).replace("{ADD}", rollup_upsert("new", "+")))
+        c.execute("""
+            create trigger if not exists transactions_rollup_delete after delete on transactions
+            when old.archived is null
+            begin {REMOVE} {DELETE_EMPTY} end
+        """.replace("{REMOVE}", rollup_upsert("old", "-")).replace("{DELETE_EMPTY}", rollup_delete_empty("old")))
+
+        self._rebuild_rollups(c)
+
+    def get_completed_backfill_windows(self, item_id: str) -> Set[Tuple[datetime.date, datetime.date]]:
+        c = self.conn.cursor()
+        r = c.execute("select start_date, end_date from backfill_windows where item_id = ?", [item_id])
+        return set(
+            (datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date))
+            for start_date, end_date in r.fetchall()
+        )
+
+    def get_item_cursor(self, item_id: str) -> Optional[str]:
+        c = self.conn.cursor()
+        r = c.execute("select cursor from items where item_id = ?", [item_id]).fetchone()
+        return r[0] if r else None
+
+    def get_item_synced_update(self, item_id: str) -> Optional[datetime.datetime]:
+        c = self.conn.cursor()
+        r = c.execute("select synced_update from items where item_id = ?", [item_id]).fetchone()
+        return datetime.datetime.fromisoformat(r[0]) if r and r[0] else None
+
+    def get_item_window_start(self, item_id: str, settle_days: int) -> Optional[datetime.date]:
+        """
+        Returns the earliest date transactions of item_id could still change
+        from: its oldest pending transaction, or settle_days before its newest
+        posted transaction, whichever is earlier. None if it has no stored
+        transactions.
+        """
+        c = self.conn.cursor()
+        oldest_pending, newest_posted = c.execute("""
+            select min(case when pending then date end), max(case when not pending then date end)
+            from transactions
+            where item_id = ? and archived is null
+        """, [item_id]).fetchone()
+
+        candidates = []
+        if oldest_pending:
+            candidates.append(datetime.date.fromisoformat(oldest_pending))
+        if newest_posted:
+            candidates.append(datetime.date.fromisoformat(newest_posted) - datetime.timedelta(days=settle_days))
+        return min(candidates) if candidates else None
+
     def get_transaction_ids(self, start_date: datetime.date, end_date: datetime.date, account_ids: List[str]) -> List[str]:
         c = self.conn.cursor()
-        res = c.execute("""
-                select transaction_id from transactions
-                where json_extract(plaid_json, '$.date') between ? and ?
-                and account_id in ({PARAMS})
-                and archived is null
-            """.replace("{PARAMS}", build_placeholders(account_ids)),
-            [start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")] + list(account_ids)
+        ret = []
+        for chunk in chunked(account_ids):
+            res = c.execute("""
+                    select transaction_id from transactions
+                    where date between ? and ?
+                    and account_id in ({PARAMS})
+                    and archived is null
+                """.replace("{PARAMS}", build_placeholders(chunk)),
+                [start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")] + chunk
+            )
+            ret += [r[0] for r in res.fetchall()]
+        return ret
+
+    def stage_transactions(self, sync_key: str, start_date: datetime.date, end_date: datetime.date,
+                           transactions: Iterable[PlaidTransaction]) -> Tuple[List[str], List[str]]:
+        """
+        Adds fetched transactions to the staging table under sync_key, and
+        compares the ones not staged before against the stored, unarchived
+        transactions between start_date and end_date.
+
+        Returns the IDs of the (new, modified) transactions; the rest are
+        unchanged. Can be called repeatedly, e.g. once per page.
+        """
+        with self.conn:
+            c = self.conn.cursor()
+            c.executemany("""
+                insert or ignore into sync_staging(sync_key, transaction_id, account_id, plaid_hash, classified)
+                    values(?,?,?,?,0)
+            """, (
+                [sync_key, t.transaction_id, t.account_id, content_hash(t.raw_data)]
+                for t in transactions
+            ))
+
+            res = c.execute("""
+                select s.transaction_id, t.transaction_id is null
+                from sync_staging s
+                left join transactions t
+                    on  t.transaction_id = s.transaction_id
+                    and t.account_id = s.account_id
+                    and t.date between ? and ?
+                    and t.archived is null
+                where s.sync_key = ? and s.classified = 0
+                and (t.transaction_id is null or t.plaid_hash is not s.plaid_hash)
+            """, [start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"), sync_key]).fetchall()
+
+            c.execute("update sync_staging set classified = 1 where sync_key = ? and classified = 0", [sync_key])
+
+        return (
+            [tid for tid, is_new in res if is_new],
+            [tid for tid, is_new in res if not is_new],
         )
+
+    def get_unstaged_transaction_ids(self, sync_key: str, start_date: datetime.date, end_date: datetime.date) -> List[str]:
+        """
+        Returns the IDs of stored, unarchived transactions between start_date
+        and end_date, for the accounts staged under sync_key, that were not
+        staged themselves - i.e. the ones Plaid no longer returns.
+        """
+        c = self.conn.cursor()
+        res = c.execute("""
+            select t.transaction_id from transactions t
+            where t.account_id in (select account_id from sync_staging where sync_key = ?)
+            and t.date between ? and ?
+            and t.archived is null
+            and not exists (
+                select 1 from sync_staging s
+                where s.sync_key = ? and s.transaction_id = t.transaction_id
+            )
+        """, [sync_key, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"), sync_key])
         return [r[0] for r in res.fetchall()]
 
+    def clear_staging(self, sync_key: str) -> int:
+        """
+        Removes everything staged under sync_key, returning the number of
+        (distinct) transactions that had been staged.
+        """
+        with self.conn:
+            c = self.conn.cursor()
+            c.execute("delete from sync_staging where sync_key = ?", [sync_key])
+            return c.rowcount
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Like `with self.conn:`, yielding a cursor, but records the time spent
+        committing as the db_commit phase of the active sync metrics.
+        """
+        try:
+            yield self.conn.cursor()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        with metrics.timer("db_commit"):
+            self.conn.commit()
+
     def archive_transactions(self, transaction_ids: List[str]):
-        c = self.conn.cursor()
+        with self.transaction() as c:
+            self._archive_transactions(c, transaction_ids)
+
+    def save_transaction(self, transaction: PlaidTransaction):
+        self.save_transactions([transaction])
+
+    def save_transactions(self, transactions: Iterable[PlaidTransaction], item_id: Optional[str]=None):
+        with self.transaction() as c:
+            self._save_transactions(c, transactions, item_id)
+
+    def save_item_info(self, item_info: AccountInfo):
+        with self.transaction() as c:
+            self._save_item_info(c, item_info)
+
+    def save_balance(self, item_id: str, balance: AccountBalance):
+        self.save_balances(item_id, [balance])
+
+    def save_balances(self, item_id: str, balances: Iterable[AccountBalance]):
+        with self.transaction() as c:
+            self._save_balances(c, item_id, balances)
+
+    def save_account_sync(self, item_info: AccountInfo, balances: Optional[Iterable[AccountBalance]],
+                          transactions: Iterable[PlaidTransaction], archive_transaction_ids: List[str],
+                          cursor: Optional[str]=None,
+                          backfill_window: Optional[Tuple[datetime.date, datetime.date]]=None,
+                          synced_update: Optional[datetime.datetime]=None,
+                          account_ids: Iterable[str]=()):
+        """
+        Saves everything fetched while synchronizing one account - item info,
+        balances, new transactions and archived transactions - in a single
+        database transaction, so either all of it is committed or none of it.
+
+        If cursor is set, it is stored as the item's /transactions/sync cursor
+        in the same transaction. If backfill_window is set, that (start, end)
+        window is checkpointed as completed for the item. If synced_update is
+        set, it is recorded as the item's last_successful_update that this
+        sync brought the transactions up to date with.
+
+        Transactions are saved with item_info's item_id; stored transactions
+        of account_ids (and of the balances' accounts) that have no item_id
+        yet are assigned to it as well.
+        """
+        with self.transaction() as c:
+            self._save_item_info(c, item_info)
+            if balances:
+                self._save_balances(c, item_info.item_id, balances)
+            self._save_transactions(c, transactions, item_info.item_id)
+            # after saving, so a transaction both saved and archived ends up archived
+            if archive_transaction_ids:
+                self._archive_transactions(c, archive_transaction_ids)
+            self._assign_item(c, item_info.item_id, set(account_ids) | set(b.account_id for b in balances or []))
+            if cursor:
+                c.execute("update items set cursor = ? where item_id = ?", [cursor, item_info.item_id])
+            if synced_update:
+                c.execute("update items set synced_update = ? where item_id = ?", [synced_update.isoformat(), item_info.item_id])
+            if backfill_window:
+                c.execute("""
+                    insert into backfill_windows(item_id, start_date, end_date, completed)
+                        values(?,?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+                        on conflict(item_id, start_date, end_date) DO UPDATE
+                            set completed = excluded.completed
+                """, [item_info.item_id, backfill_window[0].strftime("%Y-%m-%d"), backfill_window[1].strftime("%Y-%m-%d")])
+
+    def rebuild_rollups(self) -> int:
+        """
+        Regenerates daily_rollups from the transactions table, e.g. after
+        transactions were changed with the triggers disabled. Returns the
+        number of rows written.
+        """
+        with self.transaction() as c:
+            return self._rebuild_rollups(c)
+
+    def _rebuild_rollups(self, c: sqlite3.Cursor) -> int:
+        c.execute("delete from daily_rollups")
         c.execute("""
-                update transactions set archived = strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
+            insert into daily_rollups(dimension, key, date, amount, transactions)
+        """ + " union all ".join(
+            """
+                select '%s', coalesce(%s, ''), date, round(sum(amount), 4), count(*)
+                from transactions
                 where archived is null
-                and transaction_id in ({PARAMS})
-                """.replace("{PARAMS}", build_placeholders(transaction_ids)),
-                  list(transaction_ids)
-                  )
+                group by 2, 3
+            """ % (dimension, column)
+            for dimension, column in ROLLUP_DIMENSIONS
+        ))
+        return c.rowcount
 
-        self.conn.commit()
+    def _archive_transactions(self, c: sqlite3.Cursor, transaction_ids: List[str]):
+        for chunk in chunked(transaction_ids):
+            c.execute("""
+                    update transactions set archived = strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
+                    where archived is null
+                    and transaction_id in ({PARAMS})
+                    """.replace("{PARAMS}", build_placeholders(chunk)),
+                      chunk
+                      )
+            metrics.count("transactions_archived", c.rowcount)
 
-    def save_transaction(self, transaction: PlaidTransaction):
-        c = self.conn.cursor()
-        c.execute("""
+    def _assign_item(self, c: sqlite3.Cursor, item_id: str, account_ids: Iterable[str]):
+        for chunk in chunked(account_ids):
+            c.execute("""
+                    update transactions set item_id = ?
+                    where item_id is null
+                    and account_id in ({PARAMS})
+                    """.replace("{PARAMS}", build_placeholders(chunk)),
+                      [item_id] + chunk
+                      )
+
+    def _save_transactions(self, c: sqlite3.Cursor, transactions: Iterable[PlaidTransaction], item_id: Optional[str]=None):
+        c.executemany("""
             insert into
-                transactions(account_id, transaction_id, created, updated, archived, plaid_json)
-                values(?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),null,?)
+                transactions(account_id, transaction_id, created, updated, archived, plaid_json, plaid_hash,
+                             date, amount, pending, merchant_name, pending_transaction_id, item_id, category)
+                values(?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),null,?,?,?,?,?,?,?,?,?)
                 on conflict(account_id, transaction_id) DO UPDATE
                     set updated    = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
-                        plaid_json = excluded.plaid_json
-        """, [transaction.account_id, transaction.transaction_id, json.dumps(transaction.raw_data)])
-
-        self.conn.commit()
-
-    def save_item_info(self, item_info: AccountInfo):
-        c = self.conn.cursor()
+                        plaid_json = excluded.plaid_json,
+                        plaid_hash = excluded.plaid_hash,
+                        item_id = coalesce(excluded.item_id, item_id),
+                        date = excluded.date,
+                        amount = excluded.amount,
+                        pending = excluded.pending,
+                        merchant_name = excluded.merchant_name,
+                        pending_transaction_id = excluded.pending_transaction_id,
+                        category = excluded.category
+                    where plaid_hash is not excluded.plaid_hash
+        """, (
+            [transaction.account_id, transaction.transaction_id, self.encode_json(transaction.raw_data), content_hash(transaction.raw_data),
+             transaction.date, transaction.amount, transaction.pending, transaction.merchant_name,
+             transaction.pending_transaction_id, item_id, transaction.category]
+            for transaction in transactions
+        ))
+        # rows skipped by the "where plaid_hash is not" clause are not counted
+        metrics.count("transactions_written", c.rowcount)
 
+    def _save_item_info(self, c: sqlite3.Cursor, item_info: AccountInfo):
         c.execute("""
             insert into
                 items(item_id, institution_id, consent_expiration, last_failed_update, last_successful_update, updated, plaid_json)
@@ -95,17 +625,13 @@ class TransactionsDB():
                     last_failed_update = excluded.last_failed_update,
                     last_successful_update = excluded.last_successful_update,
                     plaid_json = excluded.plaid_json
-        """, [item_info.item_id, item_info.institution_id, item_info.ts_consent_expiration, item_info.ts_last_failed_update, item_info.ts_last_successful_update, json.dumps(item_info.raw_data)])
-
-        self.conn.commit()
+        """, [item_info.item_id, item_info.institution_id, item_info.ts_consent_expiration, item_info.ts_last_failed_update, item_info.ts_last_successful_update, self.encode_json(item_info.raw_data)])
 
-    def save_balance(self, item_id: str, balance: AccountBalance):
-        c = self.conn.cursor()
-
-        c.execute("""
+    def _save_balances(self, c: sqlite3.Cursor, item_id: str, balances: Iterable[AccountBalance]):
+        c.executemany("""
             insert into
                 balances(date, item_id, account_id, account_type, balance_current, balance_available, balance_limit, currency_code, updated, plaid_json)
-                values(strftime('%Y-%m-%d', 'now'),?,?,?,?,?,?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'), ?)
+                values(coalesce(?, strftime('%Y-%m-%d', 'now')),?,?,?,?,?,?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'), ?)
                 on conflict(item_id, account_id, date) DO UPDATE
                     set updated    = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
                         account_type = excluded.account_type,
@@ -114,17 +640,360 @@ class TransactionsDB():
                         balance_limit = excluded.balance_limit,
                         currency_code = excluded.currency_code,
                         plaid_json = excluded.plaid_json
-        """, [item_id, balance.account_id, balance.account_type, balance.balance_current, balance.balance_available, balance.balance_limit, balance.currency_code, json.dumps(balance.raw_data)])
+        """, (
+            [balance.date.isoformat() if balance.date else None,
+             item_id, balance.account_id, balance.account_type, balance.balance_current, balance.balance_available, balance.balance_limit, balance.currency_code, self.encode_json(balance.raw_data)]
+            for balance in balances
+        ))
+        metrics.count("balances_written", c.rowcount)
 
-        self.conn.commit()
+    def fetch_transactions_by_id(self, transaction_ids: List[str], active_only: bool=False) -> List[PlaidTransaction]:
+        """
+        Returns the stored transactions among transaction_ids; with
+        active_only, only those that are not archived.
+        """
+        c = self.conn.cursor()
+        ret = []
+        for chunk in chunked(transaction_ids):
+            r = c.execute("""
+                select plaid_json from transactions
+                where transaction_id in ({PARAMS})
+                {ACTIVE}
+            """.replace("{PARAMS}", build_placeholders(chunk))
+               .replace("{ACTIVE}", "and archived is null" if active_only else ""), chunk)
+            ret += [
+                PlaidTransaction(self.decode_json(d[0]))
+                for d in r.fetchall()
+            ]
+        return ret
+
+    def get_item_status(self) -> List[Dict]:
+        """
+        Returns the stored status of every item, as of its last sync: when
+        Plaid last refreshed it (or failed to), when its consent expires and
+        when plaid-sync last saved it and its transactions.
+        """
+        def timestamp(value):
+            return datetime.datetime.fromisoformat(value) if value else None
+
+        c = self.conn.cursor()
+        r = c.execute("""
+            select item_id, institution_id, consent_expiration, last_failed_update, last_successful_update, updated, synced_update
+            from items
+            order by institution_id, item_id
+        """)
+        return [
+            {
+                'item_id':                item_id,
+                'institution_id':         institution_id,
+                'consent_expiration':     timestamp(consent_expiration),
+                'last_failed_update':     timestamp(last_failed_update),
+                'last_successful_update': timestamp(last_successful_update),
+                'updated':                timestamp(updated),
+                'synced_update':          timestamp(synced_update),
+            }
+            for item_id, institution_id, consent_expiration, last_failed_update, last_successful_update, updated, synced_update in r.fetchall()
+        ]
+
+    def get_latest_balances(self) -> List[Dict]:
+        """
+        Returns the most recently saved balance of every account, along with
+        the account's name and mask from that balance's Plaid JSON.
+        """
+        c = self.conn.cursor()
+        r = c.execute("""
+            select date, item_id, account_id, account_type, balance_current, balance_available, balance_limit, currency_code, plaid_json
+            from balances b
+            where date = (select max(date) from balances where item_id = b.item_id and account_id = b.account_id)
+            order by item_id, account_id
+        """)
+        ret = []
+        for row in r.fetchall():
+            account = self.decode_json(row[-1])
+            ret.append(dict(
+                zip(("date", "item_id", "account_id", "account_type", "balance_current", "balance_available", "balance_limit", "currency_code"), row),
+                name=account.get('name'),
+                mask=account.get('mask'),
+            ))
+        return ret
 
-    def fetch_transactions_by_id(self, transaction_ids: List[str]) -> List[PlaidTransaction]:
+    def get_transaction_counts(self) -> List[Dict]:
+        """
+        Returns the number of active (and of those, pending) and archived
+        transactions of every account, and the date range of the active ones.
+        """
         c = self.conn.cursor()
         r = c.execute("""
-            select plaid_json from transactions
-            where transaction_id in ({PARAMS})
-        """.replace("{PARAMS}", build_placeholders(transaction_ids)), list(transaction_ids))
-        return [ 
-            PlaidTransaction(json.loads(d[0]))
-            for d in r.fetchall()
+            select item_id, account_id,
+                   sum(archived is null), sum(archived is null and pending), sum(archived is not null),
+                   min(case when archived is null then date end), max(case when archived is null then date end)
+            from transactions
+            group by item_id, account_id
+            order by item_id, account_id
+        """)
+        return [
+            dict(zip(("item_id", "account_id", "active", "pending", "archived", "first_date", "last_date"), row))
+            for row in r.fetchall()
         ]
+
+
+    def recompress(self, sample_size: int=2000) -> Dict:
+        """
+        Rewrites every stored plaid_json value with the configured compression
+        (or back to plain text, without compression), first training a new
+        shared dictionary from a sample of stored transactions, balances and
+        items. Then vacuums the database to release the freed space.
+
+        Returns the total size of the values before and after, and how long
+        decoding all transactions takes afterwards.
+        """
+        tables = ("transactions", "balances", "items")
+
+        def stored_bytes():
+            return sum(
+                self.conn.execute("select coalesce(sum(length(cast(plaid_json as blob))), 0) from %s" % table).fetchone()[0]
+                for table in tables
+            )
+
+        stats = {
+            'codec': self.compressor.codec,
+            'bytes_before': stored_bytes(),
+            'page_bytes_before': self.database_bytes(),
+        }
+
+        codec = self.compressor.codec
+        if codec:
+            # interleaved, so a size limited dictionary still covers every table
+            samples = [
+                plaid_json.encode("utf-8")
+                for table_samples in itertools.zip_longest(*(
+                    self.conn.execute("select plaid_decode(plaid_json) from %s order by random() limit ?" % table, [sample_size]).fetchall()
+                    for table in tables
+                ))
+                for row in table_samples if row
+                for plaid_json in row
+            ]
+            if samples:
+                with self.conn:
+                    self.conn.execute("""
+                        insert into json_dictionaries(codec, dictionary, created)
+                            values(?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+                    """, [codec, compression.train_dictionary(codec, samples)])
+                self.load_compressor(codec)
+            stats['dict_id'] = self.compressor.dict_id
+
+        with self.conn:
+            for table in tables:
+                self.conn.execute("update %s set plaid_json = plaid_encode(plaid_decode(plaid_json))" % table)
+            # older dictionaries are no longer used by any value
+            self.conn.execute("delete from json_dictionaries where dict_id != ?", [self.compressor.dict_id])
+        self.load_compressor(codec)
+
+        stats['bytes_after'] = stored_bytes()
+        self.conn.execute("vacuum")
+        stats['page_bytes_after'] = self.database_bytes()
+
+        start = time.perf_counter()
+        rows = decoded = 0
+        for (plaid_json,) in self.conn.execute("select plaid_decode(plaid_json) from transactions"):
+            rows    += 1
+            decoded += len(plaid_json)
+        stats['decode_rows'] = rows
+        stats['decode_chars'] = decoded
+        stats['decode_seconds'] = time.perf_counter() - start
+        return stats
+
+    def database_bytes(self) -> int:
+        page_count = self.conn.execute("pragma page_count").fetchone()[0]
+        page_size  = self.conn.execute("pragma page_size").fetchone()[0]
+        return page_count * page_size
+
+    def merge_shard(self, shard_file: str) -> Dict:
+        """
+        Folds the database written by a --shard run into this one, in a single
+        database transaction, with the shard attached so rows are copied with
+        INSERT ... SELECT rather than one by one.
+
+        Rows follow the same rules as a sync: transactions are inserted, or
+        updated if their content changed, and never un-archived; item info,
+        balances and backfill checkpoints are upserted. When this database
+        holds a newer version of a row (by its updated timestamp), it is kept.
+        plaid_json is re-encoded with this database's compression if either
+        side is compressed.
+
+        The shard is attached read-only and never written to. It has to be at
+        the current schema, as it is after the --shard run that wrote it.
+
+        Returns the number of rows inserted or updated per table.
+        """
+        if not os.path.exists(shard_file):
+            raise ValueError("Shard database [%s] does not exist" % shard_file)
+
+        self.conn.execute("attach database ? as shard", ["file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(shard_file))])
+        try:
+            version = self.conn.execute("pragma shard.user_version").fetchone()[0]
+            if version != len(self.migrations()):
+                raise ValueError("Shard database [%s] is at schema version %d, expected %d; run plaid-sync with its --shard to upgrade it" % (
+                    shard_file, version, len(self.migrations())))
+
+            tables = ("transactions", "balances", "items")
+            shard_compressed = any(
+                self.conn.execute("select exists(select 1 from shard.%s where typeof(plaid_json) = 'blob')" % table).fetchone()[0]
+                for table in tables
+            )
+
+            if shard_compressed or self.compressor.codec:
+                shard_compressor = compression.JSONCompressor(None, dict(
+                    (dict_id, (dict_codec, dictionary))
+                    for dict_id, dict_codec, dictionary in self.conn.execute("select dict_id, codec, dictionary from shard.json_dictionaries")
+                ))
+                self.conn.create_function("shard_plaid_decode", 1, shard_compressor.decompress, deterministic=True)
+                plaid_json = "plaid_encode(shard_plaid_decode(plaid_json))"
+            else:
+                plaid_json = "plaid_json"
+
+            stats = {}
+            with self.transaction() as c:
+                c.execute("""
+                    insert into
+                        main.transactions(account_id, transaction_id, created, updated, archived, plaid_json, plaid_hash,
+                                          date, amount, pending, merchant_name, pending_transaction_id, item_id, category)
+                        select account_id, transaction_id, created, updated, archived, {PLAID_JSON}, plaid_hash,
+                               date, amount, pending, merchant_name, pending_transaction_id, item_id, category
+                        from shard.transactions s
+                        -- rows that would not change are skipped before re-encoding plaid_json
+                        where not exists (
+                            select 1 from main.transactions t
+                            where t.account_id = s.account_id and t.transaction_id = s.transaction_id
+                            and t.plaid_hash is s.plaid_hash and (t.archived is not null or s.archived is null)
+                        )
+                        on conflict(account_id, transaction_id) DO UPDATE
+                            set updated    = excluded.updated,
+                                archived   = coalesce(archived, excluded.archived),
+                                plaid_json = excluded.plaid_json,
+                                plaid_hash = excluded.plaid_hash,
+                                item_id = coalesce(excluded.item_id, item_id),
+                                date = excluded.date,
+                                amount = excluded.amount,
+                                pending = excluded.pending,
+                                merchant_name = excluded.merchant_name,
+                                pending_transaction_id = excluded.pending_transaction_id,
+                                category = excluded.category
+                            where excluded.updated >= updated
+                            and (plaid_hash is not excluded.plaid_hash or (archived is null and excluded.archived is not null))
+                """.replace("{PLAID_JSON}", plaid_json))
+                stats['transactions'] = c.rowcount
+
+                c.execute("""
+                    insert into
+                        main.balances(date, item_id, account_id, account_type, balance_current, balance_available, balance_limit, currency_code, updated, plaid_json)
+                        select date, item_id, account_id, account_type, balance_current, balance_available, balance_limit, currency_code, updated, {PLAID_JSON}
+                        from shard.balances where true
+                        on conflict(item_id, account_id, date) DO UPDATE
+                            set updated    = excluded.updated,
+                                account_type = excluded.account_type,
+                                balance_current = excluded.balance_current,
+                                balance_available = excluded.balance_available,
+                                balance_limit = excluded.balance_limit,
+                                currency_code = excluded.currency_code,
+                                plaid_json = excluded.plaid_json
+                            where excluded.updated > updated
+                """.replace("{PLAID_JSON}", plaid_json))
+                stats['balances'] = c.rowcount
+
+                c.execute("""
+                    insert into
+                        main.items(item_id, institution_id, consent_expiration, last_failed_update, last_successful_update, updated, plaid_json,
+                                   cursor, synced_update)
+                        select item_id, institution_id, consent_expiration, last_failed_update, last_successful_update, updated, {PLAID_JSON},
+                               cursor, synced_update
+                        from shard.items where true
+                        on conflict(item_id) DO UPDATE
+                            set updated    = excluded.updated,
+                            institution_id = excluded.institution_id,
+                            consent_expiration = excluded.consent_expiration,
+                            last_failed_update = excluded.last_failed_update,
+                            last_successful_update = excluded.last_successful_update,
+                            plaid_json = excluded.plaid_json,
+                            cursor = excluded.cursor,
+                            synced_update = excluded.synced_update
+                            where excluded.updated > updated
+                """.replace("{PLAID_JSON}", plaid_json))
+                stats['items'] = c.rowcount
+
+                c.execute("""
+                    insert into main.backfill_windows(item_id, start_date, end_date, completed)
+                        select item_id, start_date, end_date, completed
+                        from shard.backfill_windows where true
+                        on conflict(item_id, start_date, end_date) DO UPDATE
+                            set completed = excluded.completed
+                            where excluded.completed > completed
+                """)
+                stats['backfill_windows'] = c.rowcount
+        finally:
+            self.conn.execute("detach database shard")
+        return stats
+
+
+class TransactionsDBWriter():
+    """
+    Owns a TransactionsDB on a single dedicated thread and proxies method
+    calls onto it.
+
+    sqlite3 connections cannot be shared across threads, so when several
+    accounts are synchronized concurrently every database call is sent to
+    this one writer and applied in the order it was submitted. Callers
+    block until their call has completed and get its return value (or
+    exception) back.
+    """
+    def __init__(self, *args, **kwargs):
+        self.requests = queue.Queue()
+        ready = concurrent.futures.Future()
+        self.thread = threading.Thread(
+            target=self._run,
+            args=(ready, args, kwargs),
+            name="TransactionsDBWriter",
+            daemon=True,
+        )
+        self.thread.start()
+        # surfaces any error opening the database in the calling thread
+        ready.result()
+
+    def _run(self, ready, args, kwargs):
+        try:
+            db = TransactionsDB(*args, **kwargs)
+        except Exception as ex:
+            ready.set_exception(ex)
+            return
+        ready.set_result(None)
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            future, context, name, call_args, call_kwargs = request
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # run in the caller's context, so metrics recorded by the
+                # call are attributed to the calling account
+                future.set_result(context.run(getattr(db, name), *call_args, **call_kwargs))
+            except Exception as ex:
+                future.set_exception(ex)
+
+        db.conn.close()
+
+    def __getattr__(self, name):
+        if not callable(getattr(TransactionsDB, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            future = concurrent.futures.Future()
+            self.requests.put((future, contextvars.copy_context(), name, args, kwargs))
+            return future.result()
+        return call
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()